@@ -2,11 +2,15 @@
 
 from sumoscheduler import SumoScheduler
 from sumoscheduler import Duration as dur 
+from sumo_state import SumoState, extract_states
+from timeseries_store import TimeSeriesStore
 import os
 import pandas as pd 
 import numpy as np
 import datetime
 import time 
+import queue
+import threading
 
 def create_param_dict(a_dict):
     """
@@ -115,6 +119,11 @@ class CY_SUMO():
              'trial2':{'Sumo__Plant__CSTR3__param__DOSP': 1.5,
                          'Sumo__Plant__Influent__param__Q':26000}}
         
+        `tsv_preprocessor`: TsvPreprocessor, default = None 
+        If given, every 'tsv_file' of dynamic simulations is sliced to the 
+        trial's 'stop_time' (and optionally resampled) before `loadtsv`, 
+        see tsv_preprocess.py 
+        
         
     Attributes: - Only important attributes are listed, attributes not mentioned 
                   here are for internal use.
@@ -129,6 +138,16 @@ class CY_SUMO():
                   here are for internal use.
     --------------
         `steady_state()`: run multiple steady state simulations
+        `dynamic_run()`: run multiple dynamic simulations
+        `dynamic_tree_run()`: run dynamic simulations that share a warm-up 
+        prefix, simulating each prefix once and forking trials from it
+        `extract_states()`: read variables from the saved .xml of a sweep
+        `start_steady_stream()`, `submit_steady()`, `next_steady_result()`,
+        `stop_steady_stream()`: schedule steady-state simulations one by one
+        and receive their results as they finish, e.g. for sensitivity 
+        analysis or optimisation
+        `stream_steady()`: generator running such a stream from an iterator
+        of scenarios, yielding the results as they finish
 
     Examples: 
         please refer to https://github.com/ChengYangUmich/CY_SUMO/examples
@@ -139,20 +158,17 @@ class CY_SUMO():
                  sumo_variables, 
                  paralell_job = 4,
                  default_xml = None,
-                 param_dic = None):
+                 param_dic = None,
+                 tsv_preprocessor = None):
         self.model = model
         self.sumo_variables = sumo_variables
         self.paralell_job = paralell_job
         self.default_xml = default_xml
         self.param_dic = param_dic
+        self.tsv_preprocessor = tsv_preprocessor
         self._param_commands_dic = {} # predefined, converted from self.param_dic
-        # Intermediate variable for extracting current values of state variables
-        # in SUMO
-        if param_dic == None:
-            self.current_sumo_vars = {1:None}
-        else:
-            # Create an empty nested diction for intermediate data storage
-            self.current_sumo_vars = {key:None for key in range(1,len(param_dic)+1)}   
+        self._patched_files = {} # keys: Cmd_ID; values: patched .xml not yet removed
+        if param_dic != None:
             # Add variable names from the param_dic into sumo_variables
             for a_dic in self.param_dic.values():
                 for a_var in a_dic.keys():
@@ -179,6 +195,81 @@ class CY_SUMO():
         self.sumo.message_callback = msg_callback
         self.sumo.datacomm_callback = datacomm_callback
     
+    def _start_collector(self, collect_job):
+        """
+        (Internal) method
+        
+        Callbacks are called by the sumo core from its worker threads. Each
+        job only writes the rows it receives to its own buffer in 
+        self._job_buffers, and posts an event to self._events when finished. 
+        A single collector thread started here aggregates the finished jobs, 
+        so shared tables are never written by several threads.
+        
+        Parameters:
+        --------------   
+        `collect_job`: function
+            Called by the collector thread as collect_job(jobData, rows) for 
+            every finished job, with rows being the buffered datacomm rows
+        """
+        self._job_buffers = {}
+        self._events = queue.Queue()
+        self._collector_error = None
+        self._collector = threading.Thread(target=self._collect, 
+                                           args=(collect_job,), daemon=True)
+        self._collector.start()
+    
+    def _collect(self, collect_job):
+        """
+        (Internal) method, the loop of the collector thread
+        """
+        while True:
+            event = self._events.get()
+            if event is None:
+                break
+            job, jobData = event
+            try:
+                collect_job(jobData, self._job_buffers.pop(job, []))
+            except Exception as error:
+                # Kept to be raised by _stop_collector(); the other jobs are 
+                # still collected
+                print(f"------Collecting job {job} failed: {error!r}-----")
+                if self._collector_error is None:
+                    self._collector_error = error
+    
+    def _post_finished(self, job):
+        """
+        (Internal) method, used in message callbacks to post the completion 
+        event of a job and release it
+        """
+        self._events.put((job, self.sumo.getJobData(job)))
+        self.sumo.finish(job)
+    
+    def _wait_for_jobs(self, timeout = None):
+        """
+        (Internal) method, used to wait for all scheduled jobs to finish
+
+        Returns
+        -------
+        Boolean, False if some jobs were still running after `timeout` seconds
+        """
+        start = time.time()
+        while (self.sumo.scheduledJobs > 0):
+            if timeout != None and time.time() - start > timeout:
+                return False
+            time.sleep(0.1)
+        return True
+    
+    def _stop_collector(self):
+        """
+        (Internal) method, used to wait for the collector thread to aggregate
+        all posted events, and raise the first error of `collect_job`
+        """
+        self._events.put(None)
+        self._collector.join()
+        if self._collector_error is not None:
+            error, self._collector_error = self._collector_error, None
+            raise error
+    
     def _line_command(self, a_dict, sumo_default):
         """
         (Internal) Method, used to create a one-line commands seperated with ';'
@@ -211,7 +302,46 @@ class CY_SUMO():
         commands += "start;"
         return commands
    
-    def _set_ss_commands(self,sumo_default):
+    def _patched_command(self, a_key, a_dict, patch_name):
+        """
+        (Internal) Method, used to write a patched copy of self.default_xml
+        with the parameters in a_dict applied, and create the one-line command
+        that loads it. 
+        
+        Parameters
+        ----------
+        a_key : the key of a_dict in self.param_dic 
+        a_dict : dictionary
+            a dictionary that stores the parameters to be adjusted
+            e.g. {'Sumo__Plant__CSTR3__param__DOSP': 2,
+                  'Sumo__Plant__Influent__param__Q':24000}
+        patch_name : string 
+            Prefix of the patched .xml files, e.g. "Patched_ID"
+
+        Returns
+        -------
+        commands : string 
+            e.g. "load Patched_ID_0.xml;maptoic;mode steady;start;"
+        """
+        xml_file = f"{patch_name}_{a_key}.xml"
+        self._default_state.patch(a_dict, xml_file)
+        self._patched_files[a_key] = xml_file
+        return f"load {xml_file};maptoic;mode steady;start;"
+
+    def _remove_patched(self, a_key):
+        """
+        (Internal) Method, used to delete the patched .xml of a finished 
+        scenario, if any
+        """
+        xml_file = self._patched_files.pop(a_key, None)
+        if xml_file != None:
+            try:
+                os.remove(xml_file)
+            except OSError as error:
+                print(f"------{xml_file} could not be removed: {error}-----")
+    
+    def _set_ss_commands(self,sumo_default, patch_xml = False, 
+                         patch_name = "Patched_ID"):
         """
         (Internal) Method, used to create a list of commands used for 
         steady-state simulations, and stored it in self._param_commands_dic
@@ -221,8 +351,26 @@ class CY_SUMO():
                    "set Sumo__Plant__CSTR3__param__DOSP 2",
                    "set Sumo__Plant__Influent__param__Q 24000",
                    "start"]
+        If `patch_xml` is True, the parameters are written into a patched copy
+        of self.default_xml per scenario instead, and each scenario only 
+        issues a single `load` command. 
         """
-        if sumo_default:
+        if patch_xml and not sumo_default and self.param_dic != None:
+            # Index self.default_xml once, patch it for every scenario 
+            self._default_state = SumoState(self.default_xml)
+            try:
+                if any(isinstance(i,dict) for i in self.param_dic.values()):
+                    for a_dic_key,a_dic in self.param_dic.items():
+                        self._param_commands_dic[a_dic_key] = self._patched_command(a_dic_key, a_dic, patch_name)
+                else:
+                    self._param_commands_dic[0] = self._patched_command(0, self.param_dic, patch_name)
+            except Exception:
+                # No job is scheduled, the copies written so far are removed
+                for a_key in list(self._patched_files.keys()):
+                    self._remove_patched(a_key)
+                self._param_commands_dic = {}
+                raise
+        elif sumo_default:
             self._param_commands_dic[0] = 'reset;mode steady;start'
         else:
             if self.param_dic == None:
@@ -237,7 +385,8 @@ class CY_SUMO():
     
     # Code block replicating steady-state simulations
     def steady_state(self, sumo_default = False, save_table = True, 
-                     save_name = "steady_state_result.xlsx", save_xml = False):
+                     save_name = "steady_state_result.xlsx", save_xml = False,
+                     patch_xml = False, patch_name = "Patched_ID"):
         """
         Parameters
         ----------
@@ -249,6 +398,17 @@ class CY_SUMO():
             The ouput xlsx file name saved from the self.ss_table
         save_xml: Boolean, optional
             Whether to save the .xml files for each steady state simulations
+        patch_xml: Boolean, optional
+            Whether to write a patched copy of `default_xml` per scenario with
+            its parameters applied, instead of a chain of `set` commands. 
+            Recommended for scenarios overriding many parameters. Each copy 
+            has the size of `default_xml`. All copies are written before the 
+            simulations start, so they are on disk at the same time, and each
+            is deleted once its simulation has finished. For large sweeps, 
+            `stream_steady()` with patch_xml = True only writes the copies of
+            the scheduled simulations.
+        patch_name: String, optional
+            Prefix of the patched .xml files, e.g. "Patched_ID_0.xml"
 
         Returns
         -------
@@ -257,14 +417,17 @@ class CY_SUMO():
         """
         # Pre-define variables to store steady-state simulation results 
         self.SS_table = pd.DataFrame()
+        self._ss_rows = []
         # An intermediate boolean used in steady_state_msg_callback 
         self._save_xml = save_xml
         # Create the steady-state commands in lists 
-        self._set_ss_commands(sumo_default=sumo_default)
+        self._set_ss_commands(sumo_default=sumo_default, patch_xml=patch_xml,
+                              patch_name=patch_name)
         # Register callback functions 
         msg_callback = self._steady_state_msg_callback
         datacomm_callback = self._steady_state_datacomm_callback
         self._set_up_scheduler(msg_callback, datacomm_callback)
+        self._start_collector(self._collect_steady_state)
         for a_key, a_line_command in self._param_commands_dic.items():
             commands = []
             for a_element in a_line_command.split(";"):
@@ -279,8 +442,9 @@ class CY_SUMO():
                 # blockDatacomm=True)
         print("Jobs started:", self.sumo.scheduledJobs)
         
-        while (self.sumo.scheduledJobs > 0):
-            time.sleep(0.1)
+        self._wait_for_jobs()
+        self._stop_collector()
+        self.SS_table = pd.DataFrame(self._ss_rows)
 
         # self.sumo.scheduler.cleanup()
         
@@ -289,6 +453,30 @@ class CY_SUMO():
             print(f"------SS_table saved as {save_name}-----")
     
             
+    def extract_states(self, pattern = "Cmd_ID_*.xml", variables = None, processes = None):
+        """
+        Read variables from the .xml files saved by `steady_state(save_xml = True)`,
+        in parallel, and join them to self.param_dic - no rerun needed for 
+        variables missing from `sumo_variables`. See sumo_state.extract_states()
+
+        Parameters
+        ----------
+        pattern : string, optional
+            Glob pattern of the state files. The default is "Cmd_ID_*.xml".
+        variables : list, optional
+            Sumo incode variables or wildcard patterns to read, 
+            e.g. ["Sumo__Plant__Effluent__*"]. The default is None, i.e. all
+            variables.
+        processes : int, optional
+            Number of worker processes. The default is None, i.e. all cores.
+
+        Returns
+        -------
+        table : pd.DataFrame, one row per state file
+        """
+        return extract_states(pattern = pattern, variables = variables, 
+                              param_dic = self.param_dic, processes = processes)
+    
     def _steady_state_msg_callback(self,job,msg):
         """
         (Internal) method
@@ -306,18 +494,19 @@ class CY_SUMO():
         """
         print(f"#{job} {msg}")
         if (self.sumo.isSimFinishedMsg(msg)):
+            jobData = self.sumo.getJobData(job)
             ## save the .xml files
             if self._save_xml == True:
-                jobData = self.sumo.getJobData(job)
                 xml_file = f"Cmd_ID_{jobData['Cmd_ID']}.xml"
                 command = f"save {xml_file};"
                 self.sumo.sendCommand(job,command)
                 time.sleep(2) # Increase the sleep time if the .xml is saved in malform (whose size is smaller than others)
                 print(f"{xml_file} -------- saved-----------")
-            x = pd.DataFrame([self.current_sumo_vars[job]])
-            self.SS_table = pd.concat([self.SS_table,x], ignore_index=True)
-            # self.SS_table = self.SS_table.append(self.current_sumo_vars[job],ignore_index = True)
-            self.sumo.finish(job)
+            # The patched copy loaded by the job is no longer needed. It is
+            # removed before the job is released, so none is left once 
+            # scheduledJobs is 0. 
+            self._remove_patched(jobData["Cmd_ID"])
+            self._post_finished(job)
     
     def _steady_state_datacomm_callback(self,job,data):
         """
@@ -334,13 +523,208 @@ class CY_SUMO():
         None.
 
         """
-        jobData = self.sumo.getJobData(job)
-        self.current_sumo_vars[job] = {**data,**jobData}
+        # Only the latest values of the job are kept
+        self._job_buffers[job] = [data]
+    
+    def _collect_steady_state(self, jobData, rows):
+        """
+        (Internal) method, called by the collector thread for every finished 
+        steady-state job
+        """
+        # Jobs without any datacomm row are kept, so failed scenarios show up 
+        # in SS_table with their Cmd_ID, as in _collect_stream()
+        row = {**rows[-1], **jobData} if len(rows) != 0 else dict(jobData)
+        self._ss_rows.append(row)
+        
         
+    # Code block streaming steady-state simulations one by one 
+    def start_steady_stream(self, sumo_default = False, save_xml = False,
+                            patch_xml = False, patch_name = "Patched_ID"):
+        """
+        Start a scheduler to which steady-state simulations can be submitted 
+        one by one with `submit_steady()`, while results of finished ones are
+        received with `next_steady_result()`. It keeps all parallel jobs busy
+        when the next scenarios depend on the results of previous ones. 
+        Finish with `stop_steady_stream()`.
+
+        Parameters
+        ----------
+        sumo_default, save_xml, patch_xml, patch_name : 
+            Same as in `steady_state()`
         
+        Returns
+        -------
+        None.
+        """
+        self.SS_table = pd.DataFrame()
+        self._ss_rows = []
+        self._save_xml = save_xml
+        self._stream_sumo_default = sumo_default
+        self._stream_patch_xml = patch_xml and not sumo_default
+        self._stream_patch_name = patch_name
+        if self._stream_patch_xml:
+            self._default_state = SumoState(self.default_xml)
+        # Results are handed over by the collector thread 
+        self._stream_results = queue.Queue()
+        self._set_up_scheduler(self._steady_state_msg_callback, 
+                               self._steady_state_datacomm_callback)
+        self._start_collector(self._collect_stream)
+    
+    def submit_steady(self, a_key, a_dict):
+        """
+        Schedule one steady-state simulation in the stream.
+
+        Parameters
+        ----------
+        a_key : int or string
+            The ID of the scenario, returned as "Cmd_ID" in its result
+        a_dict : dictionary
+            The parameters to adjust, 
+            e.g. {'Sumo__Plant__CSTR3__param__DOSP': 2}
+
+        Returns
+        -------
+        None.
+        """
+        if self._stream_patch_xml:
+            a_line_command = self._patched_command(a_key, a_dict, self._stream_patch_name)
+        else:
+            a_line_command = self._line_command(a_dict, self._stream_sumo_default)
+        commands = [a_element + ";" for a_element in a_line_command.split(";") if a_element != ""]
+        self.sumo.schedule(
+            model = self.model,
+            commands = commands,
+            variables = self._unique_list(self.sumo_variables + list(a_dict.keys())),
+            jobData ={"SS_cmd": a_line_command,
+                      "Cmd_ID": a_key})
+    
+    def next_steady_result(self, timeout = None):
+        """
+        Wait for the next finished simulation of the stream. 
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Seconds to wait. The default is None, i.e. wait until one finishes.
+
+        Returns
+        -------
+        row : dictionary 
+            The tracked sumo variables with "SS_cmd" and "Cmd_ID", or None if
+            none finished within `timeout`. An error of the collector thread
+            is raised instead of waiting for results it will not deliver.
+        """
+        start = time.time()
+        while True:
+            if self._collector_error is not None:
+                raise self._collector_error
+            wait = 1.0 if timeout == None else min(1.0, timeout - (time.time() - start))
+            try:
+                return self._stream_results.get(timeout = max(wait, 0))
+            except queue.Empty:
+                if timeout != None and time.time() - start >= timeout:
+                    return None
+    
+    def stop_steady_stream(self, save_table = False, 
+                           save_name = "steady_state_result.xlsx",
+                           timeout = None):
+        """
+        Wait for the remaining simulations of the stream and gather all
+        results in self.SS_table. 
+
+        Parameters
+        ----------
+        save_table, save_name : 
+            Same as in `steady_state()`
+        timeout : float, optional
+            Seconds to wait for the remaining simulations, after which a 
+            TimeoutError is raised. The default is None, i.e. no limit.
+        
+        Returns
+        -------
+        None.
+        """
+        finished = self._wait_for_jobs(timeout)
+        self._stop_collector()
+        if not finished:
+            raise TimeoutError(f"{self.sumo.scheduledJobs} simulation(s) of the stream did not finish within {timeout} s")
+        self.SS_table = pd.DataFrame(self._ss_rows)
+        if save_table == True:
+            self.SS_table.to_excel(save_name)
+            print(f"------SS_table saved as {save_name}-----")
+    
+    def stream_steady(self, scenarios, queue_depth = 1, stop = None, 
+                      timeout = None, **stream_options):
+        """
+        Run a stream of steady-state simulations, keeping 
+        `queue_depth * paralell_job` of them scheduled, and yield their 
+        result rows as they finish. Scenarios are only taken from 
+        `scenarios` when a job is free, so they can depend on the results 
+        yielded before. The stream is stopped when the generator ends, or 
+        is closed or interrupted by an error.
+
+        Parameters
+        ----------
+        scenarios : iterator
+            Yields (key, parameter dictionary) as in `submit_steady()`, or 
+            None when no scenario can be chosen before the next result. 
+            With no simulation left to wait for, None ends the stream.
+        queue_depth : int or function, optional
+            Simulations kept scheduled per parallel job, or a function 
+            returning it. The default is 1.
+        stop : function, optional
+            Called before taking a scenario: once it returns True, no more 
+            are taken and the scheduled ones are finished. The default is None.
+        timeout : float, optional
+            Seconds to wait for each result, after which a TimeoutError is 
+            raised. The default is None, i.e. no limit.
+        **stream_options :
+            Passed to `start_steady_stream()`, e.g. patch_xml = True
+
+        Yields
+        ------
+        row : dictionary, same as `next_steady_result()`
+        """
+        in_flight = 0
+        taking = True
+        self.start_steady_stream(**stream_options)
+        try:
+            while True:
+                depth = queue_depth() if callable(queue_depth) else queue_depth
+                while taking and in_flight < depth * self.paralell_job:
+                    if stop != None and stop():
+                        taking = False
+                        break
+                    a_scenario = next(scenarios, StopIteration)
+                    if a_scenario is StopIteration:
+                        taking = False
+                    if a_scenario is StopIteration or a_scenario is None:
+                        break
+                    self.submit_steady(*a_scenario)
+                    in_flight += 1
+                if in_flight == 0:
+                    break
+                row = self.next_steady_result(timeout = timeout)
+                if row == None:
+                    raise TimeoutError(f"No steady-state result within {timeout} s")
+                in_flight -= 1
+                yield row
+        finally:
+            self.stop_steady_stream(timeout = timeout)
+    
+    def _collect_stream(self, jobData, rows):
+        """
+        (Internal) method, called by the collector thread for every finished 
+        job of the stream
+        """
+        row = {**rows[-1], **jobData} if len(rows) != 0 else dict(jobData)
+        self._ss_rows.append(row)
+        self._stream_results.put(row)
+    
     # Code block replicating dynamic simulations with initial states loaded       
     def dynamic_run(self, dynamic_inputs, 
-                    save_table= True, save_name = "dynamic_result.xlsx"):
+                    save_table= True, save_name = "dynamic_result.xlsx",
+                    store_options = None):
         """
         Dynamic runs with given initial conditions (.xml), changed parameters, input functions
 
@@ -372,6 +756,14 @@ class CY_SUMO():
             Whether to save the simulations to a .xlsx file whose sheets are keys in the `dynamic_inputs`. The default is True.
         save_name : String ended with '.xlsx', optional
             Name of the excel file to save. The default is "dynamic_result.xlsx".
+        store_options : dictionary, optional
+            If given, results of each trial are kept in a compact 
+            TimeSeriesStore created with these keyword arguments, instead of 
+            a pd.DataFrame, see timeseries_store.py
+            e.g. {'dtype': np.float32, 'window': 12, 'aggregate': ('mean', 'max')}
+            The tables are then saved as compressed "<save_name>_<trial>.npz"
+            files, which can be read by TimeSeriesStore.load(). 
+            The default is None.
 
         Returns
         -------
@@ -379,29 +771,25 @@ class CY_SUMO():
 
         """
         # Create a dictionary to store dynamic simulation results
-        self._myDataDic = {key:pd.DataFrame() for key in dynamic_inputs.keys()}
+        if store_options == None:
+            self._myDataDic = {key:pd.DataFrame() for key in dynamic_inputs.keys()}
+        else:
+            self._myDataDic = {key:TimeSeriesStore(**store_options) for key in dynamic_inputs.keys()}
         msg_callback = self._msg_callback_dyn
         datacomm_callback = self._datacomm_callback_dyn
         self._set_up_scheduler(msg_callback, datacomm_callback)
+        self._start_collector(self._collect_dyn)
         
         for a_dyn_key, a_dyn_input in dynamic_inputs.items():
             # Generate the commands for inputs 
-            temp_xml = a_dyn_input['xml']
-            commands =  [f'load "{temp_xml}";', "maptoic;"]
-            if a_dyn_input['tsv_file'] != None:
-                for a_tsv in a_dyn_input['tsv_file']:
-                    commands.append(f'loadtsv "{a_tsv}";')
-            for a_constant_var, its_value in  a_dyn_input['param_dic'].items():
-                commands.append(f"set {a_constant_var} {its_value};")
-                # Add adjusted variables in sumo variable 
-                self.sumo_variables.append(a_constant_var)
+            commands = self._dynamic_commands(a_dyn_input['xml'],
+                                              a_dyn_input['tsv_file'],
+                                              a_dyn_input['param_dic'],
+                                              a_dyn_input['stop_time'],
+                                              a_dyn_input['data_comm_freq'])
             # Add dynamic input sumo variables 
             for a_dyn_var in a_dyn_input["input_fun"].keys():
                 self.sumo_variables.append(a_dyn_var)
-            commands.append(f"set Sumo__StopTime {a_dyn_input['stop_time']};")
-            commands.append(f"set Sumo__DataComm {a_dyn_input['data_comm_freq']};")
-            commands.append("mode dynamic;")
-            commands.append("start;")
             # schedule jobs 
             self.sumo.schedule(self.model, 
                                 commands=commands, 
@@ -411,20 +799,353 @@ class CY_SUMO():
                                 blockDatacomm=True)
         print("Jobs started:", self.sumo.scheduledJobs)
     
-        while (self.sumo.scheduledJobs > 0):
-            time.sleep(0.1)
+        self._wait_for_jobs()
+        self._stop_collector()
         
         self.sumo.cleanup() 
         
+        # Code block to save compact stores to compressed .npz files 
+        if save_table == True and store_options != None:
+            for a_key, a_store in self._myDataDic.items():
+                npz_name = f"{os.path.splitext(save_name)[0]}_{a_key}.npz"
+                a_store.save(npz_name)
+            print(f"{os.path.splitext(save_name)[0]}_*.npz were saved successfully")
         # Code block to save self_myDataDic to a excel file 
+        elif save_table == True:
+            with pd.ExcelWriter(save_name) as writer:
+                for a_key in list(self._myDataDic.keys()):
+                    a_df = self._myDataDic[a_key]
+                    sheet_name = f"{a_key}"
+                    a_df.to_excel(writer, sheet_name=sheet_name)
+            print(f"{save_name} was saved successfully")
+    
+    # Code block running dynamic simulations as a scenario tree 
+    def dynamic_tree_run(self, dynamic_inputs, save_table = True, 
+                         save_name = "dynamic_tree_result.xlsx",
+                         checkpoint_name = "Warmup_ID"):
+        """
+        Dynamic runs where trials sharing the same initial conditions (.xml), 
+        input tables (.tsv) and first days are forked from a common warm-up. 
+        Each shared prefix is simulated once, saved with the `save` command as
+        a checkpoint .xml, and every trial of the group continues from that 
+        checkpoint as soon as it is saved. 
+        
+        This requires the sumo core to keep the simulation clock of a state 
+        loaded without `maptoic`, so that a fork resumes at its 'fork_time'. 
+        The first row of every fork is checked: a fork restarting from time 0
+        is stopped right away, by setting its Sumo__StopTime to its current 
+        time, and a RuntimeError is raised once the other trials are finished.
+
+        Parameters
+        ----------
+        dynamic_inputs : dictionary (nested)
+            Same as in `dynamic_run()`, with an extra optional key per trial:
+            'fork_time': the simulation time (e.g. 10*dur.day) at which the 
+            trial diverges from others. Trials with the same 'xml', 'tsv_file',
+            'data_comm_freq' and 'fork_time' share one warm-up. During the 
+            warm-up, only the 'param_dic' values shared by all trials of the 
+            group are applied; the other values and 'input_fun' are NOT - 
+            they take effect from 'fork_time' on. Trials without 'fork_time' (or with 
+            'fork_time' = 0), and trials sharing their warm-up with no other 
+            trial, run as in `dynamic_run()`. 
+            e.g. 
+            dynamic_inputs = 
+                 {'Trial1':{'xml':'Cmd_ID_0.xml',
+                            'fork_time':10*dur.day,
+                            'stop_time':12*dur.day,
+                            'data_comm_freq':1*dur.hour,
+                            'param_dic':{'Sumo__Plant__CSTR3__param__DOSP': 2},
+                            'input_fun':{},
+                            'tsv_file':['Influent_Table1.tsv']},
+                  'Trial2':{'xml':'Cmd_ID_0.xml',
+                            'fork_time':10*dur.day,
+                            'stop_time':12*dur.day,
+                            'data_comm_freq':1*dur.hour,
+                            'param_dic':{'Sumo__Plant__CSTR3__param__DOSP': 1},
+                            'input_fun':{},
+                            'tsv_file':['Influent_Table1.tsv']}
+                  }
+        save_table : Boolean, optional
+            Whether to save the simulations to a .xlsx file whose sheets are 
+            keys in the `dynamic_inputs`. The default is True.
+        save_name : String ended with '.xlsx', optional
+            Name of the excel file to save. The default is "dynamic_tree_result.xlsx".
+        checkpoint_name : String, optional
+            Prefix of the checkpoint .xml files saved at the end of each 
+            warm-up, e.g. "Warmup_ID_0.xml". The default is "Warmup_ID".
+
+        Returns
+        -------
+        None. Results of each trial (warm-up rows followed by its own rows) 
+        are stored in self._myDataDic as in `dynamic_run()`. A RuntimeError is
+        raised if a forked trial does not resume at its 'fork_time', i.e. if
+        the core restarted the checkpoint from its initial conditions; such 
+        forks have no rows of their own.
+
+        """
+        # Group trials by their shared prefix 
+        self._tree_groups = self._group_dynamic_prefix(dynamic_inputs)
+        self._tree_inputs = dynamic_inputs
+        self._myDataDic = {key:pd.DataFrame() for key in dynamic_inputs.keys()}
+        self._prefixDataDic = {key:pd.DataFrame() for key in self._tree_groups.keys()}
+        # Forks whose first row was checked, and those stopped by the check,
+        # whose rows are ignored
+        self._forks_started = set()
+        self._forks_failed = set()
+        msg_callback = self._msg_callback_tree
+        datacomm_callback = self._datacomm_callback_tree
+        self._set_up_scheduler(msg_callback, datacomm_callback)
+        self._start_collector(self._collect_tree)
+        
+        # Simulate each shared prefix once and save a checkpoint; its trials 
+        # are forked by the collector as soon as it is saved. Trials without 
+        # a shared prefix start right away. 
+        self._forks_pending = sum(a_group['fork_time'] != 0 for a_group in self._tree_groups.values())
+        for a_group_id, a_group in self._tree_groups.items():
+            if a_group['fork_time'] == 0:
+                for a_dyn_key in a_group['trials']:
+                    self._schedule_tree_trial(a_dyn_key, a_group)
+                continue
+            checkpoint = f"{checkpoint_name}_{a_group_id}.xml"
+            a_group['checkpoint'] = checkpoint
+            commands = self._dynamic_commands(a_group['xml'], 
+                                              a_group['tsv_file'],
+                                              a_group['param_dic'],
+                                              a_group['fork_time'],
+                                              a_group['data_comm_freq'])
+            self.sumo.schedule(self.model, 
+                                commands=commands, 
+                                jobData= {'group_ID':a_group_id,
+                                          'checkpoint':checkpoint,
+                                          'info':{'input_fun':{}}}, 
+                                variables=self.sumo_variables,
+                                blockDatacomm=True)
+        print("Jobs started:", self.sumo.scheduledJobs)
+        # Checked first: forks are scheduled before the count is decreased 
+        while self._forks_pending > 0 or self.sumo.scheduledJobs > 0:
+            time.sleep(0.1)
+        self._stop_collector()
+        
+        self.sumo.cleanup()
+        
+        # Prepend the shared warm-up rows to each forked trial 
+        for a_group_id, a_group in self._tree_groups.items():
+            prefix_df = self._prefixDataDic[a_group_id]
+            if len(prefix_df) == 0:
+                continue
+            for a_dyn_key in a_group['trials']:
+                a_df = pd.concat([prefix_df, self._myDataDic[a_dyn_key]], ignore_index=True)
+                a_df = a_df.drop_duplicates(subset="Sumo__Time", keep="last")
+                self._myDataDic[a_dyn_key] = a_df.reset_index(drop=True)
+        
         if save_table == True:
             with pd.ExcelWriter(save_name) as writer:
                 for a_key in list(self._myDataDic.keys()):
                     a_df = self._myDataDic[a_key]
                     sheet_name = f"{a_key}"
-                    a_df.to_excel(writer, sheet_name)
+                    a_df.to_excel(writer, sheet_name=sheet_name)
             print(f"{save_name} was saved successfully")
     
+    def _schedule_tree_trial(self, a_dyn_key, a_group):
+        """
+        (Internal) method, used to schedule one trial of `dynamic_tree_run()`,
+        from its initial conditions or forked from its group's checkpoint 
+        """
+        a_dyn_input = self._tree_inputs[a_dyn_key]
+        if a_group['fork_time'] == 0:
+            # No shared prefix, start from the initial conditions
+            commands = self._dynamic_commands(a_dyn_input['xml'],
+                                              a_dyn_input['tsv_file'],
+                                              a_dyn_input['param_dic'],
+                                              a_dyn_input['stop_time'],
+                                              a_dyn_input['data_comm_freq'])
+        else:
+            # Resume from the checkpoint, keeping its simulation clock
+            commands = self._dynamic_commands(a_group['checkpoint'],
+                                              a_dyn_input['tsv_file'],
+                                              a_dyn_input['param_dic'],
+                                              a_dyn_input['stop_time'],
+                                              a_dyn_input['data_comm_freq'],
+                                              map_to_ic = False)
+        for a_dyn_var in a_dyn_input["input_fun"].keys():
+            self.sumo_variables.append(a_dyn_var)
+        self.sumo.schedule(self.model, 
+                            commands=commands, 
+                            jobData= {'key_ID':a_dyn_key,
+                                      'fork_time':a_group['fork_time'],
+                                      'info':a_dyn_input}, 
+                            variables=self.sumo_variables,
+                            blockDatacomm=True)
+    
+    def _group_dynamic_prefix(self, dynamic_inputs):
+        """
+        (Internal) method, used to group trials in `dynamic_inputs` that share
+        the same warm-up prefix. 
+
+        Returns
+        -------
+        groups : dictionary 
+            keys: (int) group ID starting from 0 
+            values: (dictionary) with 'xml', 'tsv_file', 'fork_time', 
+            'data_comm_freq', 'trials' (list of keys in `dynamic_inputs`) and
+            'param_dic' (the parameters set alike by all its trials)
+        """
+        groups = {}
+        group_keys = {}
+        for a_dyn_key, a_dyn_input in dynamic_inputs.items():
+            fork_time = a_dyn_input.get('fork_time', 0)
+            if fork_time >= a_dyn_input['stop_time']:
+                raise ValueError(f"'fork_time' of {a_dyn_key} should be smaller than its 'stop_time'")
+            tsv_files = a_dyn_input['tsv_file']
+            tsv_files = tuple(tsv_files) if tsv_files != None else None
+            a_group_key = (a_dyn_input['xml'], tsv_files, fork_time, 
+                           a_dyn_input['data_comm_freq'])
+            # Trials without prefix are not shared
+            if fork_time == 0:
+                a_group_key += (a_dyn_key,)
+            if a_group_key not in group_keys:
+                group_keys[a_group_key] = len(groups)
+                groups[group_keys[a_group_key]] = {'xml': a_dyn_input['xml'],
+                                                   'tsv_file': a_dyn_input['tsv_file'],
+                                                   'fork_time': fork_time,
+                                                   'data_comm_freq': a_dyn_input['data_comm_freq'],
+                                                   'trials': []}
+            groups[group_keys[a_group_key]]['trials'].append(a_dyn_key)
+        for a_group in groups.values():
+            # A prefix of a single trial is not shared, it runs as in dynamic_run()
+            if len(a_group['trials']) < 2:
+                a_group['fork_time'] = 0
+            # Parameters set alike by all trials are applied during the warm-up
+            param_dics = [dynamic_inputs[a_dyn_key]['param_dic'] for a_dyn_key in a_group['trials']]
+            a_group['param_dic'] = {a_var: its_value for a_var, its_value in param_dics[0].items()
+                                    if all(a_var in a_dic and a_dic[a_var] == its_value for a_dic in param_dics[1:])}
+        return groups
+    
+    def _dynamic_commands(self, xml, tsv_file, param_dic, stop_time, 
+                          data_comm_freq, map_to_ic = True):
+        """
+        (Internal) method, used to create the list of commands of a dynamic 
+        simulation.
+        
+        Parameters
+        ----------
+        xml : string 
+            The .xml file to load 
+        tsv_file : list or None
+            The .tsv files to load 
+        param_dic : dictionary 
+            The parameters to set before starting 
+        stop_time : int 
+            Value of Sumo__StopTime 
+        data_comm_freq : int 
+            Value of Sumo__DataComm 
+        map_to_ic : Boolean, optional 
+            Whether to map the loaded state to the initial conditions. False 
+            keeps the simulation clock of the loaded state. The default is True.
+
+        Returns
+        -------
+        commands : list 
+        """
+        commands = [f'load "{xml}";']
+        if map_to_ic:
+            commands.append("maptoic;")
+        if tsv_file != None:
+            for a_tsv in tsv_file:
+                if self.tsv_preprocessor != None:
+                    a_tsv = self.tsv_preprocessor.prepare(a_tsv, stop_time)
+                commands.append(f'loadtsv "{a_tsv}";')
+        for a_constant_var, its_value in param_dic.items():
+            commands.append(f"set {a_constant_var} {its_value};")
+            # Add adjusted variables in sumo variable 
+            self.sumo_variables.append(a_constant_var)
+        commands.append(f"set Sumo__StopTime {stop_time};")
+        commands.append(f"set Sumo__DataComm {data_comm_freq};")
+        commands.append("mode dynamic;")
+        commands.append("start;")
+        return commands
+    
+    def _msg_callback_tree(self,job,msg):
+        """
+        (Internal) method
+        Parameters
+        ----------
+        job : Int
+            The job ID defined in the sumo scheduler
+        msg : string 
+            Message similar to the sumo core window 
+
+        Returns
+        -------
+        None.
+
+        """
+        print(f"SUMO: #{job} {msg}")
+        if (self.sumo.isSimFinishedMsg(msg)):
+            jobData = self.sumo.getJobData(job)
+            # Save the state at the end of a warm-up as the checkpoint 
+            if 'checkpoint' in jobData:
+                self.sumo.sendCommand(job, f'save "{jobData["checkpoint"]}";')
+                time.sleep(2) # Increase the sleep time if the .xml is saved in malform (whose size is smaller than others)
+                print(f"{jobData['checkpoint']} -------- saved-----------")
+            self._post_finished(job)
+    
+    def _datacomm_callback_tree(self, job, data):
+        """
+        (Internal) method
+        Parameters
+        ----------
+        job : Int
+            The job ID defined in the sumo scheduler
+        data : dictionary 
+            Stored information defined in the self.sumo.schedule() - jobData 
+
+        Returns
+        -------
+        None.
+
+        """
+        if job in self._forks_failed:
+            return
+        jobData = self.sumo.getJobData(job)
+        if 'group_ID' in jobData:
+            data["Sumo__Time"] /= self.sumo.dur.day 
+            self._job_buffers.setdefault(job, []).append(data)
+            return
+        if jobData['fork_time'] != 0 and job not in self._forks_started:
+            self._forks_started.add(job)
+            # A fork must resume at fork_time, otherwise its rows would 
+            # silently replace the warm-up rows. It is stopped at its first 
+            # row instead of running to stop_time, and released by its 
+            # finished message as any other job. 
+            if abs(data["Sumo__Time"] - jobData['fork_time']) > jobData['info']['data_comm_freq']:
+                jobData['error'] = RuntimeError(
+                    f"{jobData['key_ID']} resumed at Sumo__Time = {data['Sumo__Time'] / self.sumo.dur.day} d "
+                    f"instead of its fork_time ({jobData['fork_time'] / self.sumo.dur.day} d) from the checkpoint")
+                self._forks_failed.add(job)
+                self.sumo.sendCommand(job, f"set Sumo__StopTime {data['Sumo__Time']};")
+                return
+        self._datacomm_callback_dyn(job, data)
+    
+    def _collect_tree(self, jobData, rows):
+        """
+        (Internal) method, called by the collector thread for every finished 
+        job of `dynamic_tree_run()`
+        """
+        if 'group_ID' in jobData:
+            self._prefixDataDic[jobData['group_ID']] = pd.DataFrame(rows)
+            # The checkpoint is saved: fork the trials of the group 
+            try:
+                a_group = self._tree_groups[jobData['group_ID']]
+                for a_dyn_key in a_group['trials']:
+                    self._schedule_tree_trial(a_dyn_key, a_group)
+            finally:
+                self._forks_pending -= 1
+        elif 'error' in jobData:
+            raise jobData['error']
+        else:
+            self._collect_dyn(jobData, rows)
+    
     def _msg_callback_dyn(self,job,msg):
         """
         (Internal) method
@@ -442,7 +1163,7 @@ class CY_SUMO():
         """
         print(f"SUMO: #{job} {msg}")
         if (self.sumo.isSimFinishedMsg(msg)):
-            self.sumo.finish(job) 
+            self._post_finished(job)
             
     def _datacomm_callback_dyn(self, job, data):
         """
@@ -461,15 +1182,24 @@ class CY_SUMO():
         """
         jobData = self.sumo.getJobData(job)
         data["Sumo__Time"] /= self.sumo.dur.day 
-        x = pd.DataFrame([data])
-        self._myDataDic[jobData['key_ID']] = pd.concat([self._myDataDic[jobData['key_ID']] ,x],ignore_index=True)
-        # self._myDataDic[jobData['key_ID']] = self._myDataDic[jobData['key_ID']].append(data,ignore_index = True)
+        # Each trial's store is only written by its own job 
+        if isinstance(self._myDataDic[jobData['key_ID']], TimeSeriesStore):
+            self._myDataDic[jobData['key_ID']].append(data)
+        else:
+            self._job_buffers.setdefault(job, []).append(data)
         if len(jobData['info']['input_fun']) !=0:
             for a_var,a_fun in jobData['info']['input_fun'].items():
                 current_value = a_fun(data["Sumo__Time"])
                 print(f"{a_var} == {current_value}")
                 self.sumo.sendCommand(job, f"set {a_var} {current_value}")
-                
+    
+    def _collect_dyn(self, jobData, rows):
+        """
+        (Internal) method, called by the collector thread for every finished 
+        dynamic job
+        """
+        if not isinstance(self._myDataDic[jobData['key_ID']], TimeSeriesStore):
+            self._myDataDic[jobData['key_ID']] = pd.DataFrame(rows)
        
     def _unique_list(self, list1):
         # initialize a null list
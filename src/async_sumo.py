@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import itertools
+import time
+import pandas as pd
+from sumo_state import SumoState
+
+
+class DynamicJob():
+    """
+    A dynamic simulation scheduled in an AsyncSumoSession.
+
+    Methods:
+    --------------
+        `rows()`: async iterator of the datacomm rows as they arrive, from the
+        first one
+        `result()`: wait for the simulation to finish, returns a pd.DataFrame
+    """
+    def __init__(self, key, future, buffer):
+        self.key = key
+        self._future = future
+        # The rows appended by the callback thread, the only copy until the
+        # result table replaces it
+        self._buffer = buffer
+        self._new_rows = asyncio.Event()
+        self._consumers = 0
+
+    def _notify(self):
+        self._new_rows.set()
+
+    async def rows(self):
+        position = 0
+        self._consumers += 1
+        try:
+            while True:
+                if self._buffer is None:
+                    # Finished: the rows are read back from the result table
+                    for row in self._future.result().iloc[position:].to_dict('records'):
+                        yield row
+                    break
+                if position < len(self._buffer):
+                    row = self._buffer[position]
+                    position += 1
+                    yield row
+                    continue
+                self._new_rows.clear()
+                # Rows appended before clear() are caught by the check above
+                if position == len(self._buffer):
+                    await self._new_rows.wait()
+        finally:
+            self._consumers -= 1
+
+    async def result(self):
+        return await self._future
+
+    def __await__(self):
+        return self._future.__await__()
+
+
+class AsyncSumoSession():
+    """
+    This is an asyncio-native interface to run the simulations of a CY_SUMO
+    object. The callbacks of the sumo core, called from its worker threads,
+    hand their data over to the event loop with `call_soon_threadsafe`, so
+    simulations run concurrently with other I/O-bound work in one process,
+    without polling or thread-pool wrappers.
+
+    Inputs:
+    --------------
+    (Mandatory)
+        `sumo`: CY_SUMO
+        The CY_SUMO object whose model, variables and parallel jobs are used
+
+    (Optional)
+        `sumo_default`, `save_xml`, `patch_xml`, `patch_name`:
+        Same as in CY_SUMO.steady_state(), for steady-state simulations
+
+    Methods:
+    --------------
+        `submit_steady()`: schedule one steady-state simulation, returns a future
+        `run_steady()`: run steady-state simulations, returns a pd.DataFrame
+        `submit_dynamic()`: schedule one dynamic simulation, returns a DynamicJob
+        `run_dynamic()`: run dynamic simulations, returns a dictionary of pd.DataFrame
+        `as_completed()`: async iterator of (key, result) of finished jobs
+
+    Examples:
+    --------------
+        async def main():
+            async with AsyncSumoSession(test) as session:
+                SS_table = await session.run_steady(param_dict)
+                job = session.submit_dynamic('Trial1', dynamic_inputs['Trial1'])
+                async for row in job.rows():
+                    print(row["Sumo__Time"])
+        asyncio.run(main())
+    """
+    def __init__(self, sumo, sumo_default = False, save_xml = False,
+                 patch_xml = False, patch_name = "Patched_ID"):
+        self.sumo = sumo
+        self.sumo_default = sumo_default
+        self.save_xml = save_xml
+        self.patch_xml = patch_xml and not sumo_default
+        self.patch_name = patch_name
+        self._tokens = itertools.count()
+        # token -> state of the job, written before scheduling
+        self._jobs = {}
+        self._loop = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def open(self):
+        """
+        Set up the scheduler. With `patch_xml`, `default_xml` is indexed in
+        the default executor of the event loop.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._completed = []
+        self._pending = 0
+        if self.patch_xml:
+            self.sumo._default_state = await self._loop.run_in_executor(None, SumoState, self.sumo.default_xml)
+        self.sumo._set_up_scheduler(self._message_callback, self._datacomm_callback)
+
+    async def close(self):
+        """
+        Wait for the scheduled jobs and release the scheduler
+        """
+        pending = [a_job["future"] for a_job in list(self._jobs.values())]
+        if len(pending) != 0:
+            await asyncio.gather(*pending, return_exceptions=True)
+        # The futures are resolved before the callback threads release their
+        # jobs, cleanup() must wait for them
+        while self.sumo.sumo.scheduledJobs > 0:
+            await asyncio.sleep(0.1)
+        self.sumo.sumo.cleanup()
+
+    # Code block running in the callback threads of the sumo core
+    def _message_callback(self, job, msg):
+        """
+        (Internal) method
+        Parameters
+        ----------
+        job : Int
+            The job ID defined in the sumo scheduler
+        msg : string
+            Message similar to the sumo core window
+        """
+        print(f"SUMO: #{job} {msg}")
+        if (self.sumo.sumo.isSimFinishedMsg(msg)):
+            jobData = self.sumo.sumo.getJobData(job)
+            a_job = self._jobs[jobData["session_ID"]]
+            if a_job["dynamic"]:
+                # The table is built in the event loop, not in the core's thread
+                result = a_job["rows"]
+            else:
+                if self.save_xml:
+                    xml_file = f"Cmd_ID_{jobData['Cmd_ID']}.xml"
+                    self.sumo.sumo.sendCommand(job, f"save {xml_file};")
+                    time.sleep(2) # Increase the sleep time if the .xml is saved in malform (whose size is smaller than others)
+                    print(f"{xml_file} -------- saved-----------")
+                result = {**a_job["rows"][-1], "SS_cmd": jobData["SS_cmd"],
+                          "Cmd_ID": jobData["Cmd_ID"]} if len(a_job["rows"]) != 0 else {"Cmd_ID": jobData["Cmd_ID"]}
+            if not a_job["dynamic"]:
+                # Removed before the job is completed and released
+                self.sumo._remove_patched(jobData["Cmd_ID"])
+            self._loop.call_soon_threadsafe(self._complete, jobData["session_ID"], result)
+            self.sumo.sumo.finish(job)
+
+    def _datacomm_callback(self, job, data):
+        """
+        (Internal) method
+        Parameters
+        ----------
+        job : Int
+            The job ID defined in the sumo scheduler
+        data : dictionary
+            The tracked sumo variables
+        """
+        jobData = self.sumo.sumo.getJobData(job)
+        a_job = self._jobs[jobData["session_ID"]]
+        if not a_job["dynamic"]:
+            # Only the latest values of the job are kept
+            a_job["rows"] = [data]
+            return
+        data["Sumo__Time"] /= self.sumo.sumo.dur.day
+        a_job["rows"].append(data)
+        if a_job["job"]._consumers > 0:
+            self._loop.call_soon_threadsafe(a_job["job"]._notify)
+        for a_var, a_fun in a_job["input_fun"].items():
+            current_value = a_fun(data["Sumo__Time"])
+            self.sumo.sumo.sendCommand(job, f"set {a_var} {current_value}")
+
+    # Code block running in the event loop
+    def _complete(self, token, result):
+        """
+        (Internal) method, called in the event loop when a job finishes
+        """
+        a_job = self._jobs.pop(token)
+        self._pending -= 1
+        if a_job["dynamic"]:
+            result = pd.DataFrame(result)
+        if not a_job["future"].done():
+            a_job["future"].set_result(result)
+        if a_job["dynamic"]:
+            a_job["job"]._buffer = None
+            a_job["job"]._notify()
+        for completed in self._completed:
+            completed.put_nowait((a_job["key"], result))
+
+    def _fail(self, token, error):
+        """
+        (Internal) method, called in the event loop when a job could not be
+        scheduled
+        """
+        a_job = self._jobs.pop(token)
+        self._pending -= 1
+        if not a_job["future"].done():
+            a_job["future"].set_exception(error)
+        if a_job["dynamic"]:
+            a_job["job"]._buffer = None
+            a_job["job"]._notify()
+        for completed in self._completed:
+            # Wakes up the iterators, which stop if no job is left
+            completed.put_nowait(None)
+
+    def _register(self, a_key, dynamic, input_fun = None):
+        """
+        (Internal) method, used to register a job before it is scheduled
+        """
+        token = next(self._tokens)
+        future = self._loop.create_future()
+        a_job = {"key": a_key, "future": future, "rows": [], "dynamic": dynamic,
+                 "input_fun": {} if input_fun == None else input_fun}
+        if dynamic:
+            a_job["job"] = DynamicJob(a_key, future, a_job["rows"])
+        self._jobs[token] = a_job
+        self._pending += 1
+        return token, a_job
+
+    def _schedule(self, token, commands, variables, dynamic, jobData = None):
+        """
+        (Internal) method, used to schedule a registered job
+        """
+        self.sumo.sumo.schedule(self.sumo.model,
+                                commands = commands,
+                                variables = variables,
+                                jobData = {**({} if jobData == None else jobData),
+                                           "session_ID": token},
+                                blockDatacomm = dynamic)
+
+    def submit_steady(self, a_key, a_dict):
+        """
+        Schedule one steady-state simulation. With `patch_xml`, the patched
+        copy of `default_xml` is written in the default executor of the
+        event loop, and the job is scheduled once it is ready. Errors of the
+        patching are raised by the future.
+
+        Parameters
+        ----------
+        a_key : int or string
+            The ID of the scenario, returned as "Cmd_ID"
+        a_dict : dictionary
+            The parameters to adjust
+
+        Returns
+        -------
+        future : asyncio.Future, resolved with the result row (dictionary)
+        """
+        token, a_job = self._register(a_key, dynamic = False)
+        if self.patch_xml:
+            # Kept so that the task is not garbage collected before it is done
+            a_job["task"] = self._loop.create_task(self._schedule_patched(token, a_key, a_dict))
+        else:
+            self._schedule_steady(token, a_key, a_dict,
+                                  self.sumo._line_command(a_dict, self.sumo_default))
+        return a_job["future"]
+
+    def _schedule_steady(self, token, a_key, a_dict, a_line_command):
+        """
+        (Internal) method, used to schedule a registered steady-state job
+        """
+        commands = [a_element + ";" for a_element in a_line_command.split(";") if a_element != ""]
+        variables = self.sumo._unique_list(self.sumo.sumo_variables + list(a_dict.keys()))
+        self._schedule(token, commands, variables, dynamic = False,
+                       jobData = {"SS_cmd": a_line_command, "Cmd_ID": a_key})
+
+    async def _schedule_patched(self, token, a_key, a_dict):
+        """
+        (Internal) method, used to write the patched copy of a steady-state
+        job off the event loop and schedule it
+        """
+        try:
+            a_line_command = await self._loop.run_in_executor(
+                None, self.sumo._patched_command, a_key, a_dict, self.patch_name)
+            self._schedule_steady(token, a_key, a_dict, a_line_command)
+        except Exception as error:
+            self.sumo._remove_patched(a_key)
+            self._fail(token, error)
+
+    async def run_steady(self, param_dic = None):
+        """
+        Run steady-state simulations and wait for all of them.
+
+        Parameters
+        ----------
+        param_dic : dictionary (nested), optional
+            The scenarios. The default is None, i.e. the param_dic of the
+            CY_SUMO object.
+
+        Returns
+        -------
+        SS_table : pd.DataFrame, one row per scenario
+        """
+        param_dic = self.sumo.param_dic if param_dic == None else param_dic
+        futures = [self.submit_steady(a_key, a_dict) for a_key, a_dict in param_dic.items()]
+        return pd.DataFrame(await asyncio.gather(*futures))
+
+    def submit_dynamic(self, a_key, a_dyn_input):
+        """
+        Schedule one dynamic simulation. The commands, including the tables
+        of the `tsv_preprocessor` of the CY_SUMO object, are prepared in the
+        default executor of the event loop, and the job is scheduled once
+        they are ready. Errors of the preparation are raised by the job.
+
+        Parameters
+        ----------
+        a_key : string
+            The ID of the trial
+        a_dyn_input : dictionary
+            One trial, as the values of `dynamic_inputs` in CY_SUMO.dynamic_run()
+
+        Returns
+        -------
+        job : DynamicJob
+        """
+        token, a_job = self._register(a_key, dynamic = True,
+                                      input_fun = a_dyn_input["input_fun"])
+        # Kept so that the task is not garbage collected before it is done
+        a_job["task"] = self._loop.create_task(self._schedule_dynamic(token, a_key, a_dyn_input))
+        return a_job["job"]
+
+    async def _schedule_dynamic(self, token, a_key, a_dyn_input):
+        """
+        (Internal) method, used to prepare the commands of a dynamic job off
+        the event loop and schedule it
+        """
+        try:
+            commands = await self._loop.run_in_executor(
+                None, self.sumo._dynamic_commands, a_dyn_input['xml'],
+                a_dyn_input['tsv_file'], a_dyn_input['param_dic'],
+                a_dyn_input['stop_time'], a_dyn_input['data_comm_freq'])
+            variables = self.sumo._unique_list(self.sumo.sumo_variables + list(a_dyn_input["input_fun"].keys()))
+            self._schedule(token, commands, variables, dynamic = True,
+                           jobData = {"key_ID": a_key})
+        except Exception as error:
+            self._fail(token, error)
+
+    async def run_dynamic(self, dynamic_inputs):
+        """
+        Run dynamic simulations and wait for all of them.
+
+        Returns
+        -------
+        results : dictionary, keys: trials; values: pd.DataFrame
+        """
+        jobs = {a_key: self.submit_dynamic(a_key, a_dyn_input)
+                for a_key, a_dyn_input in dynamic_inputs.items()}
+        return {a_key: await a_job.result() for a_key, a_job in jobs.items()}
+
+    async def as_completed(self):
+        """
+        Async iterator of (key, result) of the jobs as they finish, until no
+        job is left. Every job finishing while the iterator is active is
+        yielded once by it, including those also awaited through their
+        future; several iterators each get every job. The results of the
+        other jobs are only kept by their futures.
+        """
+        # Each iterator has its own queue, fed by _complete() while active
+        completed = asyncio.Queue()
+        self._completed.append(completed)
+        try:
+            while self._pending > 0 or not completed.empty():
+                item = await completed.get()
+                if item is not None:
+                    yield item
+        finally:
+            self._completed.remove(completed)
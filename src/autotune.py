@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import datetime
+import pandas as pd
+try:
+    import psutil # optional, used to measure CPU and memory
+except ImportError:
+    psutil = None
+
+
+class ParallelAutotuner():
+    """
+    This is an autotuner of the number of parallel jobs (`paralell_job`, passed
+    to `setParallelJobs`) and of the scheduling window (queue depth, i.e. jobs
+    kept scheduled per parallel job) of a CY_SUMO object. During the first part
+    of a steady-state sweep, candidate settings are tried one after the other
+    on the running sweep while jobs/s, CPU and memory (RSS of this process and
+    its children) are measured, starting once the jobs scheduled under the
+    previous setting have finished. The rest of the sweep runs with the best
+    setting, which is saved per model file and reused by later sweeps. If the
+    sweep ends before every setting was tried, nothing is saved and the number
+    of parallel jobs of the CY_SUMO object is kept.
+
+    CPU and memory are only measured if `psutil` is installed.
+
+    Inputs:
+    --------------
+    (Mandatory)
+        `sumo`: CY_SUMO
+        The CY_SUMO object to tune
+
+    (Optional)
+        `candidates`: list, default = None
+        The numbers of parallel jobs to try. The default is 1, 2, 4, ... up to
+        the number of CPUs, and the number of CPUs.
+
+        `queue_depths`: list, default = (1, 2, 4)
+        The queue depths to try with the best number of parallel jobs
+
+        `jobs_per_trial`: int, default = None
+        Finished jobs measured per setting. The default is 2 times the number
+        of parallel jobs of the setting, at least 4.
+
+        `memory_limit`: float, default = 0.9
+        Settings using more than this fraction of the system memory are rejected
+
+        `cache_file`: string, default = "autotune.json"
+        Where the best setting of each model file is saved
+
+    Attributes:
+    --------------
+        `trials`: pd.DataFrame, the measurements of every tried setting
+        `best`: dictionary, the chosen setting
+
+    Examples:
+    --------------
+        tuner = ParallelAutotuner(test)
+        SS_table = tuner.run(param_dict)
+        # Later sweeps and drivers of the same model:
+        tuner.apply()
+    """
+    def __init__(self, sumo, candidates = None, queue_depths = (1, 2, 4),
+                 jobs_per_trial = None, memory_limit = 0.9,
+                 cache_file = "autotune.json"):
+        self.sumo = sumo
+        if candidates == None:
+            cpus = os.cpu_count() or 1
+            candidates = [2 ** i for i in range(cpus.bit_length()) if 2 ** i <= cpus] + [cpus]
+        self.candidates = sorted(set(candidates))
+        self.queue_depths = list(queue_depths)
+        self.jobs_per_trial = jobs_per_trial
+        self.memory_limit = memory_limit
+        self.cache_file = cache_file
+        self.trials = pd.DataFrame()
+        self.best = None
+
+    # Code block persisting the best setting per model file
+    def _model_key(self):
+        return os.path.abspath(self.sumo.model)
+
+    def _load_cache(self):
+        if not os.path.isfile(self.cache_file):
+            return {}
+        with open(self.cache_file) as f:
+            return json.load(f)
+
+    def _save(self):
+        """
+        (Internal) method, only called once every planned setting was tried
+        """
+        cache = self._load_cache()
+        cache[self._model_key()] = self.best
+        with open(self.cache_file, 'w') as f:
+            json.dump(cache, f, indent=4)
+        print(f"------Best setting saved in {self.cache_file}: {self.best}-----")
+
+    def cached(self):
+        """
+        Returns
+        -------
+        best : dictionary, the saved setting of the model, or None
+        """
+        return self._load_cache().get(self._model_key())
+
+    def apply(self):
+        """
+        Set the saved number of parallel jobs on the CY_SUMO object.
+
+        Returns
+        -------
+        queue_depth : int, the saved queue depth, e.g. for the `queue_depth`
+            of SensitivityAnalysis.run(), or None if the model was not tuned
+        """
+        best = self.cached()
+        if best == None:
+            return None
+        self.sumo.paralell_job = best["paralell_job"]
+        return best["queue_depth"]
+
+    # Code block measuring the running sweep
+    def _memory(self):
+        """
+        (Internal) method, returns (RSS in bytes, fraction of system memory)
+        of this process and its children
+        """
+        if psutil == None:
+            return None, None
+        process = psutil.Process()
+        rss = process.memory_info().rss
+        for a_child in process.children(recursive=True):
+            try:
+                rss += a_child.memory_info().rss
+            except psutil.Error:
+                pass
+        return rss, rss / psutil.virtual_memory().total
+
+    def _set_parallel(self, paralell_job):
+        self.sumo.paralell_job = paralell_job
+        self.sumo.sumo.setParallelJobs(paralell_job)
+
+    def run(self, param_dic = None, retune = False, save_table = False,
+            save_name = "steady_state_result.xlsx", **stream_options):
+        """
+        Run a steady-state sweep, tuning the parallelism on its first part.
+
+        Parameters
+        ----------
+        param_dic : dictionary (nested), optional
+            The scenarios. The default is None, i.e. the param_dic of the
+            CY_SUMO object.
+        retune : Boolean, optional
+            Whether to tune again a model already saved in `cache_file`.
+            The default is False.
+        save_table, save_name :
+            Same as in CY_SUMO.steady_state()
+        **stream_options :
+            See CY_SUMO.stream_steady(). The queue depth is tuned.
+
+        Returns
+        -------
+        SS_table : pd.DataFrame, same as the SS_table of the CY_SUMO object
+        """
+        param_dic = self.sumo.param_dic if param_dic == None else param_dic
+        scenarios = list(param_dic.items())
+        best = None if retune else self.cached()
+        # Settings to try: (paralell_job, queue_depth). The other queue depths
+        # are planned once the best paralell_job is found.
+        plan = [] if best != None else [(p, 2) for p in self.candidates]
+        if best == None:
+            best = {"paralell_job": self.sumo.paralell_job, "queue_depth": 2}
+        trials = []
+        in_flight = 0
+        current = None
+
+        def start_timing(trial):
+            if psutil != None:
+                psutil.cpu_percent(interval=None)
+            trial["start"] = time.time()
+
+        def start_trial(setting):
+            self._set_parallel(setting[0])
+            n_jobs = self.jobs_per_trial if self.jobs_per_trial != None else max(4, 2 * setting[0])
+            # The jobs scheduled under the previous setting are not measured:
+            # the timing starts once they have finished
+            trial = {"paralell_job": setting[0], "queue_depth": setting[1],
+                     "start": None, "skip": in_flight, "finished": 0, "jobs": n_jobs}
+            if trial["skip"] == 0:
+                start_timing(trial)
+            return trial
+
+        def end_trial(trial):
+            elapsed = time.time() - trial["start"]
+            rss, fraction = self._memory()
+            record = {"paralell_job": trial["paralell_job"], "queue_depth": trial["queue_depth"],
+                      "jobs": trial["finished"], "seconds": elapsed,
+                      "jobs_per_s": trial["finished"] / elapsed if elapsed > 0 else 0.0,
+                      "cpu_percent": psutil.cpu_percent(interval=None) if psutil != None else None,
+                      "rss": rss, "memory_fraction": fraction}
+            record["rejected"] = fraction != None and fraction > self.memory_limit
+            print(f"------Autotune {record['paralell_job']} jobs x {record['queue_depth']}: "
+                  f"{record['jobs_per_s']:.3g} jobs/s-----")
+            return record
+
+        def best_of(records):
+            ok = [a_record for a_record in records if not a_record["rejected"]]
+            return max(ok, key=lambda a_record: a_record["jobs_per_s"]) if len(ok) != 0 else None
+
+        def end_tuning(best, complete):
+            top = best_of(trials)
+            if not complete:
+                # A partial tuning is neither saved nor applied
+                print("------The sweep ended before the tuning: the setting is not saved-----")
+            elif top != None:
+                best = {"paralell_job": top["paralell_job"], "queue_depth": top["queue_depth"],
+                        "jobs_per_s": top["jobs_per_s"],
+                        "updated": datetime.datetime.now().isoformat(timespec="seconds")}
+                self.best = best
+                self._save()
+            self._set_parallel(best["paralell_job"])
+            return best
+
+        def queue_depth():
+            return current["queue_depth"] if current != None else best["queue_depth"]
+
+        def sweep():
+            nonlocal current, in_flight
+            # The scheduler exists once the stream is started
+            if len(plan) != 0:
+                current = start_trial(plan.pop(0))
+            else:
+                self._set_parallel(best["paralell_job"])
+            while len(scenarios) != 0:
+                in_flight += 1
+                yield scenarios.pop(0)
+
+        depths_planned = False
+        for row in self.sumo.stream_steady(sweep(), queue_depth, **stream_options):
+            in_flight -= 1
+            if current == None:
+                continue
+            if current["skip"] > 0:
+                current["skip"] -= 1
+                if current["skip"] == 0:
+                    start_timing(current)
+                continue
+            current["finished"] += 1
+            if current["finished"] < current["jobs"]:
+                continue
+            trials.append(end_trial(current))
+            current = None
+            # Stop increasing the parallel jobs once the throughput drops
+            tried = [a_record for a_record in trials if a_record["queue_depth"] == 2]
+            top = best_of(tried)
+            if not depths_planned and (trials[-1]["rejected"] or
+                                       (top != None and trials[-1]["jobs_per_s"] < 0.9 * top["jobs_per_s"])):
+                plan = [a_setting for a_setting in plan if a_setting[1] != 2]
+            if len(plan) == 0 and not depths_planned and top != None:
+                depths_planned = True
+                plan = [(top["paralell_job"], d) for d in self.queue_depths if d != 2]
+            if len(plan) != 0 and len(scenarios) != 0:
+                current = start_trial(plan.pop(0))
+            else:
+                best = end_tuning(best, complete = len(plan) == 0)
+        if current != None:
+            # The sweep ended while tuning
+            if current["finished"] != 0:
+                trials.append(end_trial(current))
+            best = end_tuning(best, complete = False)
+        if save_table == True:
+            self.sumo.SS_table.to_excel(save_name)
+            print(f"------SS_table saved as {save_name}-----")
+        self.trials = pd.DataFrame(trials)
+        if self.best == None:
+            self.best = best
+        return self.sumo.SS_table
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import numpy as np
+import pandas as pd
+
+
+class RandomSearch():
+    """
+    A minimal ask/tell optimizer sampling uniformly within the bounds. Used by
+    default in AskTellDriver, and as an example of the ask/tell interface.
+
+    Inputs:
+    --------------
+        `problem`: dictionary
+        keys: (string) sumo incode variables
+        values: (tuple) their (lower, upper) bounds
+
+        `seed`: int, default = None
+    """
+    def __init__(self, problem, seed = None):
+        self.problem = problem
+        self.rng = np.random.default_rng(seed)
+
+    def ask(self):
+        return {a_var: self.rng.uniform(low, high) for a_var, (low, high) in self.problem.items()}
+
+    def tell(self, candidate, value):
+        pass
+
+
+class AskTellDriver():
+    """
+    This is an asynchronous ask/tell optimisation driver on top of CY_SUMO,
+    e.g. for calibration or aeration-cost optimisation. Instead of running
+    batches and waiting for the slowest scenario, a new candidate is asked from
+    the optimizer and scheduled as soon as any simulation finishes, so every
+    parallel job stays busy.
+
+    The optimizer only needs two methods, as in most optimisation libraries:
+        `ask()`: return a candidate - a dictionary of parameters, a list or
+        array ordered as `names`, or any object converted by `to_params`
+        `tell(candidate, value)`: receive the value (to minimize) of a
+        candidate
+    e.g. skopt.Optimizer, nevergrad optimizers (with `to_params`) or
+    optuna studies (with `to_params` suggesting the parameters). To resume
+    such optimizers from `history_file`, `from_params` rebuilds the objects
+    they expect in `tell()` from the saved parameters.
+
+    Inputs:
+    --------------
+    (Mandatory)
+        `sumo`: CY_SUMO
+        The CY_SUMO object used to run the steady-state simulations
+
+        `optimizer`: object with `ask()` and `tell()`, or a dictionary
+        {variable: (lower, upper)} to use RandomSearch
+
+        `objective`: string or function
+        The sumo incode variable to minimize, e.g. "Sumo__Plant__Effluent__SNHx",
+        or a function of a result row (dictionary) returning a float
+
+    (Optional)
+        `names`: list, default = None
+        The sumo incode variables of the candidates, when `ask()` returns
+        lists or arrays
+
+        `constraints`: dictionary, default = None
+        keys: (string) names of the constraints
+        values: (function) of a result row, feasible if <= 0
+        e.g. {"SNHx_limit": lambda row: row["Sumo__Plant__Effluent__SNHx"] - 1}
+
+        `penalty`: float, default = 1e6
+        Added to the objective told to the optimizer, times the total
+        constraint violation
+
+        `maximize`: Boolean, default = False
+        Whether to maximize the objective (its opposite is told)
+
+        `history_file`: string, default = None
+        A .csv file where every evaluation is appended as soon as it finishes.
+        If it exists, previous evaluations are told to the optimizer first.
+
+        `to_params`: function, default = None
+        Converts a candidate from `ask()` to a dictionary of parameters
+
+        `from_params`: function, default = None
+        The inverse of `to_params`: converts a dictionary of parameters read
+        from `history_file` to a candidate for `tell()`. If `to_params` is
+        given without it, previous evaluations are not told to the optimizer.
+
+    Attributes:
+    --------------
+        `history`: pd.DataFrame, all evaluations
+        `best`: dictionary, the best feasible evaluation
+
+    Examples:
+    --------------
+        driver = AskTellDriver(test, {'Sumo__Plant__CSTR3__param__DOSP': (0.5, 3)},
+                               objective = lambda row: row["Sumo__Plant__Effluent__SNHx"],
+                               history_file = "history.csv")
+        driver.run(n_evaluations = 200)
+    """
+    def __init__(self, sumo, optimizer, objective, names = None,
+                 constraints = None, penalty = 1e6, maximize = False,
+                 history_file = None, to_params = None, from_params = None):
+        if isinstance(optimizer, dict):
+            names = list(optimizer.keys()) if names == None else names
+            optimizer = RandomSearch(optimizer)
+        self.sumo = sumo
+        self.optimizer = optimizer
+        self.objective = objective
+        self.names = names
+        self.constraints = {} if constraints == None else constraints
+        self.penalty = penalty
+        self.maximize = maximize
+        self.history_file = history_file
+        self.to_params = to_params
+        self.from_params = from_params
+        self.history = pd.DataFrame()
+        self.best = None
+        self._records = []
+
+    def _params(self, candidate):
+        """
+        (Internal) method, used to convert a candidate to a parameter dictionary
+        """
+        if self.to_params != None:
+            return dict(self.to_params(candidate))
+        if isinstance(candidate, dict):
+            return dict(candidate)
+        if self.names == None:
+            raise TypeError("`names` is needed when the optimizer asks lists or arrays")
+        return dict(zip(self.names, [float(v) for v in candidate]))
+
+    def _evaluate(self, row):
+        """
+        (Internal) method, used to compute the objective and constraints of a
+        result row
+
+        Returns
+        -------
+        record : dictionary, with "objective", the constraints, "violation",
+            "feasible" and "value" (the value told to the optimizer)
+        """
+        try:
+            if callable(self.objective):
+                objective = float(self.objective(row))
+            else:
+                objective = float(row.get(self.objective, np.nan))
+            record = {"objective": objective}
+            violation = 0.0
+            for a_name, a_fun in self.constraints.items():
+                record[a_name] = float(a_fun(row))
+                violation += max(0.0, record[a_name])
+        except Exception as error:
+            # The row of a failed simulation may lack the variables
+            print(f"------Evaluation of {row.get('Cmd_ID')} failed: {error!r}-----")
+            return {"objective": np.nan, **{a_name: np.nan for a_name in self.constraints},
+                    "violation": np.nan, "feasible": False, "value": self.penalty}
+        if not all(np.isfinite(record[a_name]) for a_name in self.constraints):
+            # max(0, nan) is 0: a constraint that cannot be evaluated would
+            # count as satisfied, it is told as a failed evaluation instead
+            print(f"------Evaluation of {row.get('Cmd_ID')} failed: non-finite constraint-----")
+            record.update({"violation": np.nan, "feasible": False, "value": self.penalty})
+            return record
+        value = -objective if self.maximize else objective
+        if np.isnan(value):
+            # Failed simulations are told as infeasible
+            value = self.penalty
+        record["violation"] = violation
+        record["feasible"] = violation == 0 and not np.isnan(objective)
+        record["value"] = value + self.penalty * violation
+        return record
+
+    def _record(self, record):
+        """
+        (Internal) method, used to keep an evaluation and append it to the
+        history file
+        """
+        self._records.append(record)
+        if self.history_file != None:
+            header = not os.path.isfile(self.history_file)
+            pd.DataFrame([record]).to_csv(self.history_file, mode='a', header=header, index=False)
+        if record["feasible"] and (self.best == None or record["value"] < self.best["value"]):
+            self.best = record
+
+    def _resume(self):
+        """
+        (Internal) method, used to tell the evaluations of the history file to
+        the optimizer
+
+        Returns
+        -------
+        number of evaluations told
+        """
+        if self.history_file == None or not os.path.isfile(self.history_file):
+            return 0
+        previous = pd.read_csv(self.history_file)
+        replay = self.from_params != None or self.to_params == None
+        if not replay:
+            print(f"------Warning: `from_params` is needed to tell the evaluations of {self.history_file} to the optimizer, they are only kept in the history-----")
+        # Every column other than the ones written by run() is a parameter
+        known = ["Cmd_ID", "objective", "violation", "feasible", "value", "seconds"] + list(self.constraints.keys())
+        param_names = [a_var for a_var in previous.columns if a_var not in known]
+        if len(param_names) == 0:
+            raise ValueError(f"No parameter is found in {self.history_file}")
+        if self.names != None and not set(self.names) <= set(param_names):
+            raise ValueError(f"{self.history_file} does not have the parameters {self.names}")
+        for a_record in previous.to_dict('records'):
+            if replay:
+                params = {a_var: a_record[a_var] for a_var in param_names}
+                if self.from_params != None:
+                    candidate = self.from_params(params)
+                elif self.names == None:
+                    candidate = params
+                else:
+                    candidate = [params[a_var] for a_var in self.names]
+                self.optimizer.tell(candidate, a_record["value"])
+            self._records.append(a_record)
+            if a_record["feasible"] and (self.best == None or a_record["value"] < self.best["value"]):
+                self.best = a_record
+        print(f"------{len(previous)} evaluations resumed from {self.history_file}-----")
+        return len(previous)
+
+    def run(self, n_evaluations = 100, queue_depth = 1, target = None,
+            **stream_options):
+        """
+        Run the optimisation.
+
+        Parameters
+        ----------
+        n_evaluations : int, optional
+            Total number of evaluations, including the resumed ones.
+            The default is 100.
+        queue_depth : int, optional
+            See CY_SUMO.stream_steady(). The default is 1, i.e. candidates 
+            are asked as late as possible.
+        target : float, optional
+            Stop asking candidates once a feasible value <= target is found.
+            The default is None.
+        **stream_options :
+            See CY_SUMO.stream_steady()
+
+        Returns
+        -------
+        best : dictionary, same as self.best
+        """
+        n_done = self._resume()
+        in_flight = {}   # Cmd_ID -> (candidate, parameters, time submitted)
+
+        def candidates():
+            for n_asked in range(n_done, n_evaluations):
+                candidate = self.optimizer.ask()
+                params = self._params(candidate)
+                a_key = f"eval_{n_asked}"
+                in_flight[a_key] = (candidate, params, time.time())
+                yield a_key, params
+
+        def reached():
+            return target != None and self.best != None and self.best["value"] <= target
+
+        for row in self.sumo.stream_steady(candidates(), queue_depth, stop = reached,
+                                           **stream_options):
+            candidate, params, submitted = in_flight.pop(row["Cmd_ID"])
+            record = {"Cmd_ID": row["Cmd_ID"], **params, **self._evaluate(row),
+                      "seconds": time.time() - submitted}
+            self.optimizer.tell(candidate, record["value"])
+            self._record(record)
+        self.history = pd.DataFrame(self._records)
+        return self.best
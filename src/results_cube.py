@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import numpy as np
+import pandas as pd
+from timeseries_store import TimeSeriesStore
+
+_META_FILE = "meta.json"
+_SCENARIO_FILE = "scenarios.csv"
+_OVER_TIME = {'mean': np.nanmean, 'min': np.nanmin, 'max': np.nanmax,
+              'last': lambda a, axis: np.take(a, -1, axis=axis)}
+
+
+class ResultsCube():
+    """
+    This is a labelled N-dimensional store of simulation results, indexed by
+    scenario (and its parameters), time and variable. Values are kept on disk
+    in chunks of scenarios and times (memory-mapped .npy files of shape
+    (variables, chunk_size, time_chunk), i.e. variable-major), and only the
+    scenario table is held in memory, so selecting, pivoting and aggregating
+    tens of thousands of scenarios never loads the whole cube into RAM, and a
+    slice of a few variables and times only reads their own pages.
+
+    Inputs:
+    --------------
+    (Mandatory)
+        `path`: string
+        The folder of the cube. An existing cube is opened; otherwise a new
+        one is created, and the inputs below are needed.
+
+    (Optional, only to create a cube)
+        `variables`: list
+        The sumo incode variables stored
+
+        `param_names`: list
+        The scenario parameters, e.g. the keys of each dictionary in `param_dic`
+
+        `times`: list or np.array, default = None
+        The time axis (days). None for steady-state results (one time, 0).
+        Dynamic results are interpolated on it.
+
+        `chunk_size`: int, default = 256
+        Number of scenarios per chunk file
+
+        `time_chunk`: int, default = 1024
+        Number of times per chunk file
+
+        `dtype`: string, default = 'float32'
+
+    Methods:
+    --------------
+        `append()`: add the results of one scenario
+        `flush()`: write the scenario table to disk
+        `select()`: find scenarios by their parameters
+        `sel()`: read a slice of the cube as a pd.DataFrame
+        `aggregate()`: aggregate variables by parameters, chunk by chunk
+        `pivot()`: aggregate one variable against two parameters
+
+    Examples:
+    --------------
+        cube = cube_from_ss_table("ss_cube", test.SS_table,
+                                  param_names = list(param_dict[0].keys()),
+                                  variables = sumo_variables)
+        cube.pivot("Sumo__Plant__Effluent__SNHx",
+                   index = "Sumo__Plant__CSTR3__param__DOSP",
+                   columns = "Sumo__Plant__Influent__param__Q")
+    """
+    def __init__(self, path, variables = None, param_names = None, times = None,
+                 chunk_size = 256, time_chunk = 1024, dtype = 'float32'):
+        self.path = path
+        meta_file = os.path.join(path, _META_FILE)
+        if os.path.isfile(meta_file):
+            with open(meta_file) as f:
+                meta = json.load(f)
+            self.variables = meta["variables"]
+            self.param_names = meta["param_names"]
+            self.times = np.array(meta["times"])
+            self.chunk_size = meta["chunk_size"]
+            self.time_chunk = meta["time_chunk"]
+            self.dtype = meta["dtype"]
+            self.scenarios = pd.read_csv(os.path.join(path, _SCENARIO_FILE))
+            self.scenarios["Cmd_ID"] = self.scenarios["Cmd_ID"].astype(str)
+            self._rows = self.scenarios.to_dict('records')
+        else:
+            if variables == None or param_names == None:
+                raise ValueError(f"{path} is not a cube, `variables` and `param_names` are needed to create it")
+            os.makedirs(path, exist_ok=True)
+            self.variables = list(variables)
+            self.param_names = list(param_names)
+            self.times = np.array([0.0]) if times is None else np.asarray(times, dtype=float)
+            self.chunk_size = chunk_size
+            self.time_chunk = min(time_chunk, len(self.times))
+            self.dtype = dtype
+            self._rows = []
+            with open(meta_file, 'w') as f:
+                json.dump({"variables": self.variables, "param_names": self.param_names,
+                           "times": self.times.tolist(), "chunk_size": self.chunk_size,
+                           "time_chunk": self.time_chunk, "dtype": self.dtype}, f)
+            self.flush()
+        self._variable_index = {a_var: i for i, a_var in enumerate(self.variables)}
+        self._time_chunks = range(0, len(self.times), self.time_chunk)
+        self._chunk = None  # (chunk number, memmaps of its time chunks) opened for writing
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _chunk_file(self, number, t_number):
+        return os.path.join(self.path, f"chunk_{number:05d}_{t_number:05d}.npy")
+
+    def _writable_chunk(self, number):
+        """
+        (Internal) method, used to open (or create) the time chunks of a
+        chunk of scenarios for writing
+        """
+        if self._chunk == None or self._chunk[0] != number:
+            self._flush_chunk()
+            chunks = []
+            for t_number, start in enumerate(self._time_chunks):
+                a_file = self._chunk_file(number, t_number)
+                if os.path.isfile(a_file):
+                    chunks.append(np.load(a_file, mmap_mode='r+'))
+                else:
+                    # Not filled: every row is fully written by append()
+                    length = min(self.time_chunk, len(self.times) - start)
+                    chunks.append(np.lib.format.open_memmap(a_file, mode='w+', dtype=self.dtype,
+                                                            shape=(len(self.variables), self.chunk_size, length)))
+            self._chunk = (number, chunks)
+        return self._chunk[1]
+
+    def _flush_chunk(self):
+        if getattr(self, "_chunk", None) != None:
+            for a_chunk in self._chunk[1]:
+                a_chunk.flush()
+
+    def _to_array(self, data):
+        """
+        (Internal) method, used to convert the results of one scenario to an
+        array (times, variables)
+
+        Parameters
+        ----------
+        data : dictionary (one steady-state row), pd.DataFrame or
+            TimeSeriesStore (dynamic results with a "Sumo__Time" column)
+        """
+        values = np.full((len(self.times), len(self.variables)), np.nan)
+        if isinstance(data, TimeSeriesStore):
+            data = data.to_frame()
+        if isinstance(data, dict):
+            for a_var, i in self._variable_index.items():
+                if a_var in data and isinstance(data[a_var], (int, float)):
+                    values[:, i] = data[a_var]
+            return values
+        data = data.sort_values("Sumo__Time")
+        t = data["Sumo__Time"].to_numpy(dtype=float)
+        for a_var, i in self._variable_index.items():
+            if a_var in data:
+                column = data[a_var].to_numpy(dtype=float)
+                ok = ~np.isnan(column)
+                if ok.sum() != 0:
+                    values[:, i] = np.interp(self.times, t[ok], column[ok], left=np.nan, right=np.nan)
+        return values
+
+    def append(self, a_key, params, data):
+        """
+        Add the results of one scenario.
+
+        Parameters
+        ----------
+        a_key : int or string
+            The ID of the scenario
+        params : dictionary
+            Its parameters, e.g. {'Sumo__Plant__CSTR3__param__DOSP': 2}
+        data : dictionary, pd.DataFrame or TimeSeriesStore
+            Its results, see _to_array()
+        """
+        position = len(self._rows)
+        chunks = self._writable_chunk(position // self.chunk_size)
+        values = self._to_array(data).T
+        for a_chunk, start in zip(chunks, self._time_chunks):
+            a_chunk[:, position % self.chunk_size] = values[:, start:start + a_chunk.shape[2]]
+        self._rows.append({"Cmd_ID": str(a_key), **{a_param: params.get(a_param, np.nan)
+                                                    for a_param in self.param_names}})
+
+    def flush(self):
+        """
+        Write the scenario table and the open chunk to disk
+        """
+        self._flush_chunk()
+        self.scenarios = pd.DataFrame(self._rows, columns=["Cmd_ID"] + self.param_names)
+        self.scenarios.to_csv(os.path.join(self.path, _SCENARIO_FILE), index=False)
+
+    def select(self, where = None):
+        """
+        Parameters
+        ----------
+        where : dictionary, optional
+            keys: parameters; values: a value, a list of values, or a slice
+            (inclusive bounds), e.g. {'Sumo__Plant__Influent__param__Q': 24000,
+            'Sumo__Plant__CSTR3__param__DOSP': slice(1, 2)}
+
+        Returns
+        -------
+        positions : np.array of the selected scenarios
+        """
+        if len(self.scenarios) != len(self._rows):
+            self.scenarios = pd.DataFrame(self._rows, columns=["Cmd_ID"] + self.param_names)
+        mask = np.ones(len(self.scenarios), dtype=bool)
+        for a_param, condition in ({} if where == None else where).items():
+            column = self.scenarios[a_param]
+            if isinstance(condition, slice):
+                if condition.start != None:
+                    mask &= (column >= condition.start).to_numpy()
+                if condition.stop != None:
+                    mask &= (column <= condition.stop).to_numpy()
+            elif isinstance(condition, (list, tuple, set, np.ndarray)):
+                mask &= column.isin(list(condition)).to_numpy()
+            else:
+                mask &= np.isclose(column.to_numpy(dtype=float), float(condition))
+        return np.flatnonzero(mask)
+
+    def _time_index(self, time):
+        """
+        (Internal) method, used to find the time positions: None for all, a
+        value for the nearest time, or a slice (inclusive bounds)
+        """
+        if time is None:
+            return np.arange(len(self.times))
+        if isinstance(time, slice):
+            start = -np.inf if time.start == None else time.start
+            stop = np.inf if time.stop == None else time.stop
+            return np.flatnonzero((self.times >= start) & (self.times <= stop))
+        return np.array([int(np.argmin(np.abs(self.times - time)))])
+
+    def _read(self, positions, t_index, v_index):
+        """
+        (Internal) method, used to read (scenarios, times, variables) chunk by
+        chunk, yielding (positions, values)
+        """
+        positions = np.asarray(positions)
+        t_numbers = t_index // self.time_chunk
+        for number in np.unique(positions // self.chunk_size):
+            in_chunk = positions[positions // self.chunk_size == number]
+            values = np.empty((len(in_chunk), len(t_index), len(v_index)))
+            for t_number in np.unique(t_numbers):
+                in_time = t_numbers == t_number
+                chunk = np.load(self._chunk_file(number, t_number), mmap_mode='r')
+                # Only the selected (variable, scenario, time) elements are read
+                block = chunk[np.ix_(v_index, in_chunk % self.chunk_size,
+                                     t_index[in_time] % self.time_chunk)]
+                values[:, in_time, :] = block.transpose(1, 2, 0)
+            yield in_chunk, values
+
+    def sel(self, variables = None, where = None, time = None):
+        """
+        Read a slice of the cube.
+
+        Parameters
+        ----------
+        variables : list, optional
+            The variables to read. The default is None, i.e. all.
+        where : dictionary, optional
+            Conditions on the parameters, see select()
+        time : None, float or slice, optional
+            None for all times, a value for the nearest time, or a slice
+
+        Returns
+        -------
+        a_df : pd.DataFrame
+            One row per (scenario, time), with the parameters, "Sumo__Time"
+            and the variables as columns
+        """
+        variables = self.variables if variables == None else variables
+        v_index = [self._variable_index[a_var] for a_var in variables]
+        t_index = self._time_index(time)
+        frames = []
+        for in_chunk, values in self._read(self.select(where), t_index, v_index):
+            a_df = pd.DataFrame(values.reshape(-1, len(variables)), columns=variables)
+            scenarios = self.scenarios.iloc[np.repeat(in_chunk, len(t_index))].reset_index(drop=True)
+            a_df.insert(0, "Sumo__Time", np.tile(self.times[t_index], len(in_chunk)))
+            frames.append(pd.concat([scenarios, a_df], axis=1))
+        if len(frames) == 0:
+            return pd.DataFrame(columns=list(self.scenarios.columns) + ["Sumo__Time"] + variables)
+        return pd.concat(frames, ignore_index=True)
+
+    def aggregate(self, variables, by, where = None, time = None,
+                  over_time = 'mean', func = 'mean'):
+        """
+        Aggregate variables by parameters, reading one chunk at a time.
+
+        Parameters
+        ----------
+        variables : list
+            The variables to aggregate
+        by : list
+            The parameters to group by
+        where, time :
+            See sel()
+        over_time : string, optional
+            Reduction of each scenario over the selected times: 'mean', 'min',
+            'max' or 'last'. The default is 'mean'.
+        func : string, optional
+            Aggregation across scenarios of the same group, as in
+            pd.DataFrame.groupby().agg(). The default is 'mean'.
+
+        Returns
+        -------
+        a_df : pd.DataFrame indexed by `by`
+        """
+        v_index = [self._variable_index[a_var] for a_var in variables]
+        t_index = self._time_index(time)
+        reduce = _OVER_TIME[over_time]
+        frames = []
+        for in_chunk, values in self._read(self.select(where), t_index, v_index):
+            # Each scenario is reduced over time before grouping
+            a_df = pd.DataFrame(reduce(values, axis=1), columns=variables)
+            frames.append(pd.concat([self.scenarios.iloc[in_chunk][by].reset_index(drop=True), a_df], axis=1))
+        if len(frames) == 0:
+            return pd.DataFrame(columns=by + variables).set_index(by)
+        return pd.concat(frames, ignore_index=True).groupby(by).agg(func)
+
+    def pivot(self, variable, index, columns, where = None, time = None,
+              over_time = 'mean', func = 'mean'):
+        """
+        Aggregate one variable against two parameters, e.g. effluent NH4
+        against DO setpoints and flows.
+
+        Returns
+        -------
+        a_df : pd.DataFrame, `index` values as rows and `columns` values as columns
+        """
+        a_df = self.aggregate([variable], [index, columns], where=where, time=time,
+                              over_time=over_time, func=func)
+        return a_df[variable].unstack(columns)
+
+
+def cube_from_ss_table(path, SS_table, param_names, variables, chunk_size = 256):
+    """
+    Create a cube from the steady-state results of CY_SUMO (self.SS_table)
+
+    Parameters
+    ----------
+    path : string, the folder of the cube
+    SS_table : pd.DataFrame, with one row per scenario and a "Cmd_ID" column
+    param_names : list, the columns of the scenario parameters
+    variables : list, the columns of the results
+
+    Returns
+    -------
+    cube : ResultsCube
+    """
+    cube = ResultsCube(path, variables=variables, param_names=param_names,
+                       chunk_size=chunk_size)
+    for a_row in SS_table.to_dict('records'):
+        cube.append(a_row.get("Cmd_ID", len(cube)), a_row, a_row)
+    cube.flush()
+    return cube
+
+
+def cube_from_dynamic(path, data_dic, dynamic_inputs, variables, times,
+                      chunk_size = 256, time_chunk = 1024):
+    """
+    Create a cube from the dynamic results of CY_SUMO (self._myDataDic)
+
+    Parameters
+    ----------
+    path : string, the folder of the cube
+    data_dic : dictionary, keys: trials; values: pd.DataFrame or TimeSeriesStore
+    dynamic_inputs : dictionary, the inputs of `dynamic_run()`, whose
+        'param_dic' of each trial gives the scenario parameters
+    variables : list, the variables to store
+    times : list or np.array, the time axis (days) the results are interpolated on
+
+    Returns
+    -------
+    cube : ResultsCube
+    """
+    param_names = []
+    for a_dyn_input in dynamic_inputs.values():
+        for a_param in a_dyn_input['param_dic'].keys():
+            if a_param not in param_names:
+                param_names.append(a_param)
+    cube = ResultsCube(path, variables=variables, param_names=param_names,
+                       times=times, chunk_size=chunk_size, time_chunk=time_chunk)
+    for a_key, data in data_dic.items():
+        cube.append(a_key, dynamic_inputs[a_key]['param_dic'], data)
+    cube.flush()
+    return cube
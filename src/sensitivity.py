@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+
+
+class SensitivityAnalysis():
+    """
+    This is a global sensitivity analysis engine on top of CY_SUMO. It
+    generates the sample design, streams the scenarios through the steady-state
+    simulations of a CY_SUMO object keeping all parallel jobs busy, and updates
+    the sensitivity indices as results arrive. Sampling stops early when the
+    bootstrapped confidence intervals of the indices are narrow enough. Each
+    completed sample is added once to running sums of the estimators and of
+    their (Poisson) bootstrap replicates, so a convergence check does not
+    depend on the number of samples.
+
+    Two methods are available:
+        'morris': Morris elementary effects screening, one sample being a
+        trajectory of (k+1) simulations. Indices: mu, mu_star, sigma.
+        'sobol': Sobol first-order and total indices (Saltelli/Jansen
+        estimators), one sample being (k+2) simulations. Indices: S1, ST.
+    with k the number of parameters.
+
+    Inputs:
+    --------------
+    (Mandatory)
+        `sumo`: CY_SUMO
+        The CY_SUMO object used to run the steady-state simulations
+
+        `problem`: dictionary
+        keys: (string) sumo incode variables
+        values: (tuple) their (lower, upper) bounds
+        e.g. {'Sumo__Plant__CSTR3__param__DOSP': (0.5, 3),
+              'Sumo__Plant__Influent__param__Q': (18000, 26000)}
+
+        `output`: string or function
+        The sumo incode variable analysed, e.g. "Sumo__Plant__Effluent__SNHx",
+        or a function of a result row (dictionary) returning a float
+
+    (Optional)
+        `method`: string, default = 'sobol'
+        'morris' or 'sobol'
+
+        `num_levels`: int, default = 4
+        Number of grid levels of the Morris method
+
+        `seed`: int, default = None
+        Seed of the random sample design
+
+    Attributes:
+    --------------
+        `indices`: pd.DataFrame, the sensitivity indices and their confidence
+        intervals ('_conf', half-width), one row per parameter, or None if
+        no sample completed
+        `samples`: pd.DataFrame, all simulated scenarios and their output
+        `history`: pd.DataFrame, the convergence check after every
+        `check_every` samples, with the number of samples skipped so far
+        ("failed") because a simulation failed or gave no output
+
+    Examples:
+    --------------
+        test = CY_SUMO(model = model, sumo_variables = sumo_variables,
+                       default_xml = "A2O.xml")
+        sa = SensitivityAnalysis(test, problem, "Sumo__Plant__Effluent__SNHx",
+                                 method = 'morris')
+        sa.run(max_samples = 50, tol = 0.1)
+    """
+    def __init__(self, sumo, problem, output, method = 'sobol',
+                 num_levels = 4, seed = None):
+        if method not in ('morris', 'sobol'):
+            raise ValueError(f"method should be 'morris' or 'sobol', got {method}")
+        self.sumo = sumo
+        self.problem = problem
+        self.names = list(problem.keys())
+        self.lower = np.array([bounds[0] for bounds in problem.values()], dtype=float)
+        self.upper = np.array([bounds[1] for bounds in problem.values()], dtype=float)
+        self.output = output
+        self.method = method
+        self.num_levels = num_levels
+        self.rng = np.random.default_rng(seed)
+        self.indices = None
+        self.samples = pd.DataFrame()
+        self.history = pd.DataFrame()
+
+    # Code block generating the sample design in the unit hypercube
+    def _morris_trajectory(self):
+        """
+        (Internal) method, returns (k+1, k) points of one Morris trajectory
+        """
+        k = len(self.names)
+        p = self.num_levels
+        delta = p / (2 * (p - 1))
+        # Start from the lower half of the grid, so x + delta stays in [0, 1]
+        x = self.rng.integers(0, p // 2, size=k) / (p - 1)
+        points = [x.copy()]
+        for i in self.rng.permutation(k):
+            x[i] += delta
+            points.append(x.copy())
+        return np.array(points)
+
+    def _sobol_sample(self):
+        """
+        (Internal) method, returns (k+2, k) points: A, B and the k AB_i
+        """
+        k = len(self.names)
+        a = self.rng.random(k)
+        b = self.rng.random(k)
+        points = [a, b]
+        for i in range(k):
+            ab = a.copy()
+            ab[i] = b[i]
+            points.append(ab)
+        return np.array(points)
+
+    def _output_value(self, row):
+        """
+        (Internal) method, used to get the analysed output from a result row
+        """
+        if callable(self.output):
+            try:
+                return float(self.output(row))
+            except Exception:
+                # Such samples are skipped as non-finite
+                return np.nan
+        return float(row.get(self.output, np.nan))
+
+    # Code block updating the indices with running sums
+    def _sample_stats(self, outputs, design):
+        """
+        (Internal) method, used to compute the terms of the estimators
+        contributed by one completed sample
+
+        Parameters
+        ----------
+        outputs : np.array (runs per sample)
+        design : np.array (runs per sample, k), points in the unit hypercube
+
+        Returns
+        -------
+        stats : np.array, concatenated terms summed over the samples
+        """
+        if self.method == 'morris':
+            steps = np.diff(design, axis=0)                 # (k, k)
+            changed = np.argmax(np.abs(steps), axis=1)      # factor moved at each step
+            effects = np.empty(len(self.names))
+            effects[changed] = np.diff(outputs) / steps[np.arange(len(changed)), changed]
+            return np.concatenate([effects, np.abs(effects), effects ** 2])
+        f_a, f_b, f_ab = outputs[0], outputs[1], outputs[2:]
+        # Shifted by the first output to keep the variance sums accurate
+        x = np.array([f_a, f_b]) - self._shift
+        return np.concatenate([[x.sum(), (x ** 2).sum()],
+                               f_b * (f_ab - f_a), (f_a - f_ab) ** 2])
+
+    def _update(self, outputs, design):
+        """
+        (Internal) method, used to add one completed sample to the running
+        sums of the estimate (row 0) and of the bootstrap replicates (other
+        rows, Poisson bootstrap: each sample is counted a Poisson(1) number of
+        times in each replicate)
+        """
+        if self.method == 'sobol' and self._shift == None:
+            self._shift = outputs[0]
+        stats = self._sample_stats(outputs, design)
+        weights = np.concatenate([[1.0], self.rng.poisson(1.0, size=self._n_bootstrap)])
+        if self._sums is None:
+            self._sums = np.zeros((len(weights), len(stats)))
+            self._counts = np.zeros(len(weights))
+        self._sums += weights[:, None] * stats[None, :]
+        self._counts += weights
+
+    def _compute(self, conf_level):
+        """
+        (Internal) method, used to compute the indices and their bootstrapped
+        confidence intervals from the running sums
+
+        Returns
+        -------
+        indices : pd.DataFrame
+        width : float, the largest confidence interval width of the
+            convergence criterion (normalized mu_star or ST)
+        """
+        k = len(self.names)
+        alpha = (1 - conf_level) / 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = self._sums / self._counts[:, None]
+        n = self._counts[0]
+
+        def half_width(boot):
+            return (np.nanquantile(boot, 1 - alpha, axis=0) - np.nanquantile(boot, alpha, axis=0)) / 2
+
+        if self.method == 'morris':
+            mu, mu_star, squares = means[:, :k], means[:, k:2 * k], means[:, 2 * k:]
+            sigma = np.sqrt(np.maximum(squares[0] - mu[0] ** 2, 0) * n / (n - 1)) if n > 1 else np.full(k, np.nan)
+            conf = half_width(mu_star[1:])
+            indices = pd.DataFrame({'mu': mu[0], 'mu_star': mu_star[0], 'sigma': sigma,
+                                    'mu_star_conf': conf}, index=self.names)
+            scale = np.max(mu_star[0])
+            width = np.max(2 * conf) / scale if scale > 0 else (0.0 if scale == 0 else np.nan)
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                # Each sample counts two values (A and B) in the variance
+                variance = means[:, 1] / 2 - (means[:, 0] / 2) ** 2
+                first = means[:, 2:2 + k] / variance[:, None]
+                total = 0.5 * means[:, 2 + k:] / variance[:, None]
+            conf_first = half_width(first[1:])
+            conf_total = half_width(total[1:])
+            indices = pd.DataFrame({'S1': first[0], 'S1_conf': conf_first,
+                                    'ST': total[0], 'ST_conf': conf_total}, index=self.names)
+            width = np.max(2 * conf_total)
+        return indices, width
+
+    def run(self, max_samples = 256, tol = 0.05, min_samples = 10,
+            check_every = 5, n_bootstrap = 200, conf_level = 0.95,
+            queue_depth = 2, **stream_options):
+        """
+        Run the analysis.
+
+        Parameters
+        ----------
+        max_samples : int, optional
+            Maximum number of samples (Morris trajectories or Sobol base
+            samples). The default is 256.
+        tol : float, optional
+            Sampling stops once the largest confidence interval width is below
+            `tol` - of ST for 'sobol', of mu_star divided by its largest value
+            for 'morris'. None disables early stopping. The default is 0.05.
+        min_samples : int, optional
+            Samples completed before checking convergence. The default is 10.
+        check_every : int, optional
+            Samples completed between two convergence checks. The default is 5.
+        n_bootstrap : int, optional
+            Number of bootstrap resamples. The default is 200.
+        conf_level : float, optional
+            Level of the confidence intervals. The default is 0.95.
+        queue_depth, **stream_options :
+            See CY_SUMO.stream_steady(). The default queue_depth is 2.
+
+        Returns
+        -------
+        indices : pd.DataFrame or None, same as self.indices
+        """
+        self._n_bootstrap = n_bootstrap
+        self._sums = None
+        self._shift = None
+        self.indices = None
+        new_sample = self._morris_trajectory if self.method == 'morris' else self._sobol_sample
+        designs = {}      # sample ID -> points
+        outputs = {}      # sample ID -> outputs
+        remaining = {}    # sample ID -> number of simulations left
+        in_flight = {}    # Cmd_ID -> (sample ID, position)
+        completed = []
+        failed = []
+        samples = []
+        history = []
+        stop_sampling = False
+
+        def scenarios():
+            # A sample is started only before convergence, and then fully
+            # submitted
+            for sample_id in range(max_samples):
+                if stop_sampling:
+                    return
+                points = new_sample()
+                designs[sample_id] = points
+                outputs[sample_id] = np.full(len(points), np.nan)
+                remaining[sample_id] = len(points)
+                for position, a_point in enumerate(points):
+                    values = self.lower + a_point * (self.upper - self.lower)
+                    a_key = f"{self.method}_{sample_id}_{position}"
+                    in_flight[a_key] = (sample_id, position)
+                    yield a_key, dict(zip(self.names, values))
+
+        for row in self.sumo.stream_steady(scenarios(), queue_depth, **stream_options):
+            sample_id, position = in_flight.pop(row["Cmd_ID"])
+            outputs[sample_id][position] = self._output_value(row)
+            samples.append({"sample": sample_id, "position": position, **row,
+                            "output": outputs[sample_id][position]})
+            remaining[sample_id] -= 1
+            if remaining[sample_id] > 0:
+                continue
+            sample_outputs, sample_design = outputs.pop(sample_id), designs.pop(sample_id)
+            if not np.all(np.isfinite(sample_outputs)):
+                # Failed simulations or missing outputs would make every
+                # estimate NaN, the sample is left out
+                failed.append(sample_id)
+                print(f"------Sample {sample_id} skipped: non-finite output-----")
+                continue
+            completed.append(sample_id)
+            self._update(sample_outputs, sample_design)
+            if len(completed) >= min_samples and len(completed) % check_every == 0:
+                self.indices, width = self._compute(conf_level)
+                converged = tol != None and np.isfinite(width) and width < tol
+                history.append({"samples": len(completed), "simulations": len(samples),
+                                "failed": len(failed), "width": width, "converged": converged})
+                print(f"------{len(completed)} samples, CI width {width:.4g}-----")
+                if converged:
+                    stop_sampling = True
+
+        # Only complete samples are used, in-flight ones are drained above
+        if len(completed) != 0:
+            self.indices, width = self._compute(conf_level)
+        self.samples = pd.DataFrame(samples)
+        self.history = pd.DataFrame(history)
+        return self.indices
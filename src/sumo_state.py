@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+
+import re
+import os
+import glob
+import fnmatch
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+# One pass over the file finds both the variable headers and their values
+_STATE_PATTERN = re.compile(rb'<(\w+) name="([^"]+)"[^>]*>|<value>([^<]*)</value>')
+
+
+def _convert_value(var_type, raw):
+    """
+    Convert the raw bytes between <value></value> to a python value based on
+    the variable type ('int', 'bool', 'real', 'realarray', 'string')
+    """
+    text = raw.decode('utf8')
+    if var_type in ('int', 'bool'):
+        try:
+            return int(text)
+        except ValueError:
+            return float(text)
+    if var_type in ('real', 'realarray'):
+        return float(text)
+    return text
+
+
+def _format_value(value):
+    """
+    Convert a python value to the text written between <value></value>
+    """
+    if isinstance(value, (bool, np.bool_)):
+        return str(int(value))
+    if isinstance(value, np.generic):
+        value = value.item()
+    return str(value)
+
+
+class SumoState():
+    """
+    This is an indexed reader of the SUMO state files (.xml) generated by the
+    `save` command, e.g. 'Cmd_ID_0.xml'. The file is scanned once and the byte
+    positions of every <value> are indexed, so that reading a variable is a
+    dictionary lookup and writing a patched copy only streams the unchanged
+    parts of the file around the overridden values.
+
+    Inputs:
+    --------------
+        `xml_file`: str
+        The state file to read, e.g. "Cmd_ID_0.xml"
+
+    Methods:
+    --------------
+        `get()`: read the value of one sumo incode variable
+        `to_dict()`: read the values of several sumo incode variables
+        `patch()`: write a copy of the state file with overridden values
+
+    Examples:
+    --------------
+        state = SumoState("A2O.xml")
+        state.get("Sumo__Plant__CSTR3__param__DOSP")
+        state.patch({"Sumo__Plant__CSTR3__param__DOSP": 2}, "Patched_ID_0.xml")
+    """
+    def __init__(self, xml_file):
+        self.xml_file = xml_file
+        with open(xml_file, 'rb') as f:
+            self._buffer = f.read()
+        # keys: sumo incode variables; values: (type, [(start, end), ...])
+        self._index = {}
+        self._build_index()
+
+    def _build_index(self):
+        """
+        (Internal) method, used to index the byte spans of all values
+        """
+        current = None
+        for match in _STATE_PATTERN.finditer(self._buffer):
+            if match.group(2) is not None:
+                current = []
+                self._index[match.group(2).decode('utf8')] = (match.group(1).decode('utf8'), current)
+            elif current is not None:
+                current.append(match.span(3))
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def names(self):
+        """
+        Returns
+        -------
+        list of all sumo incode variables in the state file
+        """
+        return list(self._index.keys())
+
+    def get(self, name):
+        """
+        Parameters
+        ----------
+        name : string
+            The sumo incode variable, e.g. "Sumo__Plant__Effluent__SNHx"
+
+        Returns
+        -------
+        value : int/float/string, or a list of them for arrays
+        """
+        if name not in self._index:
+            raise KeyError(f"{name} is not found in {self.xml_file}")
+        var_type, spans = self._index[name]
+        values = [_convert_value(var_type, self._buffer[start:end]) for start, end in spans]
+        return values[0] if len(values) == 1 else values
+
+    def to_dict(self, variables = None):
+        """
+        Parameters
+        ----------
+        variables : list, optional
+            The sumo incode variables to read. The default is None, i.e. all.
+
+        Returns
+        -------
+        a_dict : dictionary
+            keys: (string) sumo incode variables; values: their values
+        """
+        if variables == None:
+            variables = self._index.keys()
+        return {a_var: self.get(a_var) for a_var in variables}
+
+    def patch(self, overrides, out_file):
+        """
+        Write a copy of the state file with some values overridden.
+
+        Parameters
+        ----------
+        overrides : dictionary
+            keys: (string) sumo incode variables
+            values: (int/float/string, or list/tuple/np.ndarray for arrays)
+            their new values
+            e.g. {'Sumo__Plant__CSTR3__param__DOSP': 2,
+                  'Sumo__Plant__Influent__param__Q':24000}
+        out_file : string
+            Name of the patched .xml file
+
+        Returns
+        -------
+        None.
+        """
+        replacements = []
+        for a_var, a_val in overrides.items():
+            if a_var not in self._index:
+                raise KeyError(f"{a_var} is not found in {self.xml_file}")
+            spans = self._index[a_var][1]
+            values = list(np.ravel(a_val)) if isinstance(a_val, (list, tuple, np.ndarray)) else [a_val]
+            for a_value in values:
+                if not isinstance(a_value, (int, float, str, np.number, np.bool_)):
+                    raise TypeError(f"{a_var} expects scalar values, got {type(a_value).__name__}")
+            if len(values) != len(spans):
+                raise ValueError(f"{a_var} expects {len(spans)} value(s), got {len(values)}")
+            for a_span, a_value in zip(spans, values):
+                replacements.append((a_span, _format_value(a_value).encode('utf8')))
+        replacements.sort()
+        # Stream the unchanged parts around the replaced values
+        with open(out_file, 'wb') as f:
+            position = 0
+            for (start, end), a_value in replacements:
+                f.write(self._buffer[position:start])
+                f.write(a_value)
+                position = end
+            f.write(self._buffer[position:])
+
+
+def _select_variables(names, variables):
+    """
+    (Internal) function, used to select sumo incode variables by names or 
+    wildcard patterns, e.g. ["Sumo__Time", "Sumo__Plant__Effluent__*"]
+    """
+    if variables == None:
+        return list(names)
+    selected = []
+    name_set = set(names)
+    for a_var in variables:
+        if any(c in a_var for c in "*?["):
+            selected += [a_name for a_name in names if fnmatch.fnmatchcase(a_name, a_var)]
+        elif a_var in name_set:
+            selected.append(a_var)
+        else:
+            raise KeyError(f"{a_var} is not found in the state file")
+    return selected
+
+
+def _read_state(xml_file, variables):
+    """
+    (Internal) function, run in the worker processes of `extract_states()`
+    """
+    state = SumoState(xml_file)
+    return state.to_dict(_select_variables(state.names(), variables))
+
+
+def extract_states(pattern = "Cmd_ID_*.xml", variables = None, param_dic = None,
+                   id_pattern = r"Cmd_ID_(.+)\.xml$", processes = None):
+    """
+    Read variables from many saved state files in parallel, e.g. the .xml 
+    saved by `steady_state(save_xml = True)`, without rerunning simulations. 
+    
+    Note: on Windows, call it under `if __name__ == "__main__":` in scripts,
+    as the files are read in a process pool. 
+
+    Parameters
+    ----------
+    pattern : string, optional
+        Glob pattern of the state files. The default is "Cmd_ID_*.xml".
+    variables : list, optional
+        Sumo incode variables or wildcard patterns to read, 
+        e.g. ["Sumo__Plant__Effluent__*", "Sumo__Plant__CSTR3__DOSP"]. 
+        The default is None, i.e. all variables.
+    param_dic : dictionary (nested), optional
+        The `param_dic` of the sweep. Its parameters are joined to the rows
+        by the ID parsed from the file names. The default is None.
+    id_pattern : string, optional
+        Regular expression extracting the ID of a file from its name. 
+        The default is r"Cmd_ID_(.+)\.xml$".
+    processes : int, optional
+        Number of worker processes. The default is None, i.e. all cores.
+
+    Returns
+    -------
+    table : pd.DataFrame 
+        One row per state file with columns "Cmd_ID", "xml_file", the 
+        parameters from `param_dic`, and the selected variables.
+    """
+    xml_files = sorted(glob.glob(pattern))
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        states = list(pool.map(_read_state, xml_files, [variables]*len(xml_files)))
+    # Keys of param_dic may be int (create_param_dict) or strings
+    params = {} if param_dic == None else {str(key): val for key, val in param_dic.items()}
+    rows = []
+    for xml_file, a_state in zip(xml_files, states):
+        match = re.search(id_pattern, os.path.basename(xml_file))
+        cmd_id = match.group(1) if match else None
+        rows.append({"Cmd_ID": cmd_id, "xml_file": xml_file, 
+                     **params.get(cmd_id, {}), **a_state})
+    return pd.DataFrame(rows)
+
+
+def diff_states(xml_a, xml_b, variables = None, rtol = 1e-9, atol = 0):
+    """
+    Compare two saved state files and list the variables that changed.
+
+    Parameters
+    ----------
+    xml_a, xml_b : string or SumoState
+        The state files to compare, e.g. "Cmd_ID_0.xml", "Cmd_ID_1.xml"
+    variables : list, optional
+        Sumo incode variables or wildcard patterns to compare. 
+        The default is None, i.e. all variables in both files.
+    rtol, atol : float, optional
+        Numeric values are considered changed if 
+        |b - a| > atol + rtol * |a|. The defaults are 1e-9 and 0.
+
+    Returns
+    -------
+    diff : pd.DataFrame
+        One row per changed variable with columns "variable", "a", "b" and 
+        "difference" (b - a, for numeric scalars). Variables missing in one 
+        of the files are listed with None. 
+    """
+    state_a = xml_a if isinstance(xml_a, SumoState) else SumoState(xml_a)
+    state_b = xml_b if isinstance(xml_b, SumoState) else SumoState(xml_b)
+    names_a = state_a.names()
+    names_b = set(state_b.names())
+    seen = set(names_a)
+    names = names_a + [a_name for a_name in state_b.names() if a_name not in seen]
+    rows = []
+    for a_var in _select_variables(names, variables):
+        a_val = state_a.get(a_var) if a_var in state_a else None
+        b_val = state_b.get(a_var) if a_var in names_b else None
+        if _changed(a_val, b_val, rtol, atol):
+            numeric = all(isinstance(v, (int, float)) for v in (a_val, b_val))
+            rows.append({"variable": a_var, "a": a_val, "b": b_val,
+                         "difference": b_val - a_val if numeric else None})
+    return pd.DataFrame(rows, columns=["variable", "a", "b", "difference"])
+
+
+def _changed(a_val, b_val, rtol, atol):
+    """
+    (Internal) function, used to compare two values read from state files
+    """
+    if isinstance(a_val, list) and isinstance(b_val, list):
+        return len(a_val) != len(b_val) or any(_changed(a, b, rtol, atol) for a, b in zip(a_val, b_val))
+    if isinstance(a_val, (int, float)) and isinstance(b_val, (int, float)):
+        return abs(b_val - a_val) > atol + rtol * abs(a_val)
+    return a_val != b_val
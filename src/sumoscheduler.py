@@ -4,6 +4,7 @@ from ctypes import c_double, c_int, c_uint, c_short
 from ctypes import c_char, c_char_p, c_longlong, c_ulonglong
 import time
 import os
+import threading
 
 import platform
 import sys
@@ -26,6 +27,11 @@ class SumoScheduler:
         self.message_callback = None
         self.datacomm_callback = None
         self.scheduledJobs = 0
+        # Guards scheduledJobs and jobData, which are also updated from the 
+        # callback threads of the core. It is never held during calls to the
+        # core, whose worker threads take it in their callbacks.
+        self._lock = threading.Condition(threading.RLock())
+        self._scheduling = 0
         self._load_sumo(sumoPath)
         self.jobData = { }
         self.dur = Duration()
@@ -128,9 +134,17 @@ class SumoScheduler:
         
     def schedule (self, model, commands, variables, blockDatacomm=False, jobData=None):
         varstr = "|".join(variables)
-        self.scheduledJobs += 1      
-        id = self.scheduler.schedule(model.encode("utf8"), (";".join(commands)).encode("utf8"), varstr.encode("utf8"), int(blockDatacomm))
-        self.jobData[id] = jobData
+        with self._lock:
+            self.scheduledJobs += 1      
+            self._scheduling += 1
+        try:
+            id = self.scheduler.schedule(model.encode("utf8"), (";".join(commands)).encode("utf8"), varstr.encode("utf8"), int(blockDatacomm))
+            with self._lock:
+                self.jobData[id] = jobData
+        finally:
+            with self._lock:
+                self._scheduling -= 1
+                self._lock.notify_all()
        
     def setParallelJobs(self, jobs):
         self.scheduler.setParallelJobs(jobs)
@@ -139,16 +153,22 @@ class SumoScheduler:
         self.scheduler.setMaxJobReuse(reuse)
         
     def finish(self, job):
-        self.scheduledJobs -= 1
         self.scheduler.finish(job)
-        if (self.jobData[job] == None or not (self.persistent in self.jobData[job]) or  self.jobData[job][self.persistent] != True):
-            del self.jobData[job]
+        with self._lock:
+            if (self.jobData[job] == None or not (self.persistent in self.jobData[job]) or  self.jobData[job][self.persistent] != True):
+                del self.jobData[job]
+            # Decremented last, so that a job counted as done no longer uses
+            # jobData when cleanup() clears it
+            self.scheduledJobs -= 1
         
     def sendCommand(self, job, command):
         self.scheduler.sendCommand(job, command.encode("utf8"))
                
     def getJobData(self, jobId):
-        return self.jobData[jobId]
+        with self._lock:
+            # A callback may come before schedule() has stored the data of its job
+            self._lock.wait_for(lambda: jobId in self.jobData or self._scheduling == 0)
+            return self.jobData[jobId]
         
     def isSimFinishedMsg(self, msg):
         return msg.startswith("530004")
@@ -157,7 +177,8 @@ class SumoScheduler:
         self.scheduler.setLogDetails(level)
 
     def cleanup(self):
-        self.jobData.clear()
+        with self._lock:
+            self.jobData.clear()
         self.scheduler.cleanup()
         
     def frange(self, start, end, step):
@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import numpy as np
+import pandas as pd
+
+
+class GaussianProcess():
+    """
+    A small Gaussian process regressor (RBF kernel) in numpy. Inputs are scaled
+    to [0, 1] with the given bounds, and the length scale and noise are chosen
+    by maximizing the marginal likelihood over a grid at every fit, on at most
+    `max_tune` of the training points.
+
+    Any regressor with `fit(X, y)` and `predict(X, return_std=True)`, e.g.
+    sklearn.gaussian_process.GaussianProcessRegressor, can be used instead.
+    """
+    def __init__(self, lower, upper, length_scales = (0.05, 0.1, 0.2, 0.5, 1.0, 2.0),
+                 noises = (1e-6, 1e-3, 1e-2, 1e-1), max_tune = 200):
+        self.lower = np.asarray(lower, dtype=float)
+        self.span = np.where(np.asarray(upper) > self.lower, np.asarray(upper) - self.lower, 1.0)
+        self.length_scales = length_scales
+        self.noises = noises
+        self.max_tune = max_tune
+
+    def _kernel(self, a, b, length_scale):
+        # Squared distances without building an (n_a, n_b, d) array
+        d2 = (a ** 2).sum(axis=1)[:, None] + (b ** 2).sum(axis=1)[None, :] - 2 * a @ b.T
+        d2 = np.clip(d2, 0, None)
+        return np.exp(-0.5 * d2 / length_scale ** 2)
+
+    def fit(self, X, y):
+        self._X = (np.asarray(X, dtype=float) - self.lower) / self.span
+        y = np.asarray(y, dtype=float)
+        self._mean = y.mean()
+        self._scale = y.std() if y.std() > 0 else 1.0
+        y = (y - self._mean) / self._scale
+        # The grid is searched on evenly spaced points of the training set, 
+        # only the chosen kernel is factorized on all of them
+        tune = np.linspace(0, len(y) - 1, min(len(y), self.max_tune)).astype(int)
+        candidates = []
+        for length_scale in self.length_scales:
+            K = self._kernel(self._X[tune], self._X[tune], length_scale)
+            for noise in self.noises:
+                try:
+                    L, alpha = self._factorize(K, noise, y[tune])
+                except np.linalg.LinAlgError:
+                    continue
+                likelihood = -0.5 * y[tune] @ alpha - np.log(np.diag(L)).sum()
+                candidates.append((likelihood, length_scale, noise))
+        for _, length_scale, noise in sorted(candidates, reverse=True):
+            try:
+                L, self._alpha = self._factorize(self._kernel(self._X, self._X, length_scale), noise, y)
+            except np.linalg.LinAlgError:
+                continue
+            self.length_scale = length_scale
+            # Inverted once, predictions only multiply by it
+            self._L_inv = np.linalg.inv(L)
+            return self
+        raise np.linalg.LinAlgError("No kernel of the grid could be factorized")
+
+    def _factorize(self, K, noise, y):
+        L = np.linalg.cholesky(K + noise * np.eye(len(y)))
+        return L, np.linalg.solve(L.T, np.linalg.solve(L, y))
+
+    def predict(self, X, return_std = False):
+        X = (np.asarray(X, dtype=float) - self.lower) / self.span
+        K_s = self._kernel(X, self._X, self.length_scale)
+        mean = K_s @ self._alpha * self._scale + self._mean
+        if not return_std:
+            return mean
+        v = self._L_inv @ K_s.T
+        std = np.sqrt(np.clip(1.0 - (v ** 2).sum(axis=0), 0, None)) * self._scale
+        return mean, std
+
+
+class SurrogateScreening():
+    """
+    This is a surrogate pre-screening layer for large steady-state sweeps. A
+    surrogate model per output (objective and constraints) is trained on the
+    completed simulations as they arrive, pending scenarios are ranked by
+    their predictions, and scenarios predicted to be infeasible or dominated
+    - beyond an uncertainty bound - are skipped. A fraction of the skipped
+    scenarios is still simulated to validate the decisions.
+
+    A scenario is skipped when, with `kappa` standard deviations:
+        - a constraint is violated even at its lower bound: mean - kappa*std > limit
+        - or its objective cannot beat the best feasible result:
+          mean - kappa*std > best objective
+
+    Inputs:
+    --------------
+    (Mandatory)
+        `sumo`: CY_SUMO
+        The CY_SUMO object used to run the steady-state simulations
+
+        `param_dic`: dictionary, nested
+        The scenarios, as in CY_SUMO, e.g. from create_param_dict()
+
+        `objective`: string or function
+        The sumo incode variable to minimize, or a function of a result row
+
+    (Optional)
+        `constraints`: dictionary, default = None
+        keys: (string) sumo incode variables or names
+        values: (tuple) (upper limit, None) or (upper limit, function of a row)
+        e.g. {"Sumo__Plant__Effluent__SNHx": (1.0, None)}
+
+        `kappa`: float, default = 2
+        Width of the uncertainty bound, in standard deviations
+
+        `model`: function, default = None
+        Called as model(lower, upper) to create a regressor per output.
+        The default is GaussianProcess.
+
+        `max_train`: int, default = 500
+        The most finished scenarios used to train a surrogate, sampled at
+        random from the finished ones
+
+        `chunk_size`: int, default = 2000
+        Pending scenarios predicted at once
+
+    Attributes:
+    --------------
+        `report`: pd.DataFrame, one row per scenario with its status
+        ('run', 'skipped', 'validated'), the predictions made before it was
+        decided, and the simulated values
+        `validation`: dictionary, statistics of the predictions against the
+        simulated values
+
+    Examples:
+    --------------
+        screen = SurrogateScreening(test, param_dict,
+                                    objective = "Sumo__Plant__Blower__Power",
+                                    constraints = {"Sumo__Plant__Effluent__SNHx": (1.0, None)})
+        screen.run(n_initial = 20)
+    """
+    def __init__(self, sumo, param_dic, objective, constraints = None,
+                 kappa = 2, model = None, seed = None, max_train = 500,
+                 chunk_size = 2000):
+        self.sumo = sumo
+        self.max_train = max_train
+        self.chunk_size = chunk_size
+        self.param_dic = param_dic
+        self.objective = objective
+        self.constraints = {} if constraints == None else constraints
+        self.kappa = kappa
+        self.rng = np.random.default_rng(seed)
+        self.keys = list(param_dic.keys())
+        self.names = []
+        for a_dic in param_dic.values():
+            for a_var in a_dic.keys():
+                if a_var not in self.names:
+                    self.names.append(a_var)
+        self.X = np.array([[float(param_dic[a_key].get(a_var, np.nan)) for a_var in self.names]
+                           for a_key in self.keys])
+        lower, upper = np.nanmin(self.X, axis=0), np.nanmax(self.X, axis=0)
+        if model == None:
+            model = GaussianProcess
+        self.outputs = ["objective"] + list(self.constraints.keys())
+        self.models = {an_output: model(lower, upper) for an_output in self.outputs}
+        self.report = pd.DataFrame()
+        self.validation = {}
+
+    def _values(self, row):
+        """
+        (Internal) method, used to get the objective and constraints of a row
+        """
+        def value(a_fun, a_var):
+            if a_fun == None:
+                return float(row.get(a_var, np.nan))
+            try:
+                return float(a_fun(row))
+            except Exception:
+                # Missing outputs are not used for training, and make a 
+                # scenario infeasible in the report
+                return np.nan
+
+        values = {}
+        if callable(self.objective):
+            values["objective"] = value(self.objective, None)
+        else:
+            values["objective"] = value(None, self.objective)
+        for a_name, (limit, a_fun) in self.constraints.items():
+            values[a_name] = value(a_fun, a_name)
+        return values
+
+    def _fit(self, done, results):
+        """
+        (Internal) method, used to train the surrogates on the finished scenarios
+
+        Returns
+        -------
+        Boolean, whether all surrogates could be trained
+        """
+        X = self.X[done]
+        for an_output in self.outputs:
+            y = np.array([results[i][an_output] for i in done])
+            ok = np.flatnonzero(~np.isnan(y))
+            if len(ok) < 2:
+                return False
+            if len(ok) > self.max_train:
+                ok = np.sort(self.rng.choice(ok, self.max_train, replace=False))
+            self.models[an_output].fit(X[ok], y[ok])
+        return True
+
+    def _predict(self, pending):
+        """
+        (Internal) method, used to predict (mean, std) of every output, 
+        `chunk_size` scenarios at a time
+        """
+        predicted = {}
+        for an_output in self.outputs:
+            chunks = [self.models[an_output].predict(self.X[pending[start:start + self.chunk_size]], return_std=True)
+                      for start in range(0, len(pending), self.chunk_size)]
+            predicted[an_output] = (np.concatenate([mean for mean, std in chunks]),
+                                    np.concatenate([std for mean, std in chunks]))
+        return predicted
+
+    def run(self, n_initial = 20, refit_every = None, validate_fraction = 0.05,
+            queue_depth = 2, **stream_options):
+        """
+        Run the sweep with pre-screening.
+
+        Parameters
+        ----------
+        n_initial : int, optional
+            Random scenarios simulated before the surrogates are used.
+            The default is 20.
+        refit_every : int, optional
+            Finished simulations between two trainings of the surrogates. The
+            pending scenarios are screened again after every training only.
+            The default is None, i.e. the number of parallel jobs.
+        validate_fraction : float, optional
+            Fraction of the skipped scenarios simulated anyway, to validate the
+            skip decisions. The default is 0.05.
+        queue_depth, **stream_options :
+            See CY_SUMO.stream_steady(). The default queue_depth is 2.
+
+        Returns
+        -------
+        report : pd.DataFrame, same as self.report
+        """
+        if n_initial < 2:
+            raise ValueError("n_initial should be at least 2 to train the surrogates")
+        n = len(self.keys)
+        refit_every = self.sumo.paralell_job if refit_every == None else refit_every
+        status = np.array(["pending"] * n, dtype=object)
+        predictions = [{} for i in range(n)]
+        results = {}
+        done = []
+        in_flight = {}
+        initial = list(self.rng.permutation(n)[:n_initial])
+        since_fit = 0
+        trained = False
+        # Without trained surrogates, the remaining scenarios are all simulated
+        screening = True
+        # (scenario, status) to simulate, ranked at the last training; None 
+        # when the pending scenarios have to be screened again
+        order = None
+
+        def submit(i, a_status):
+            status[i] = a_status
+            in_flight[self.keys[i]] = i
+            return self.keys[i], self.param_dic[self.keys[i]]
+
+        def scenarios():
+            nonlocal order
+            while True:
+                if len(initial) != 0:
+                    yield submit(initial.pop(0), "run")
+                    continue
+                pending = np.flatnonzero(status == "pending")
+                if len(pending) == 0:
+                    return
+                if not trained:
+                    # Wait for the surrogates
+                    yield None
+                    continue
+                if not screening:
+                    yield submit(pending[0], "run")
+                    continue
+                if order == None:
+                    ranked, skip = self._screen(pending, done, results, predictions)
+                    validate = []
+                    for i in skip:
+                        if self.rng.random() < validate_fraction:
+                            validate.append((i, "validated"))
+                        else:
+                            status[i] = "skipped"
+                    order = collections.deque(validate + [(i, "run") for i in ranked])
+                if len(order) == 0:
+                    # Every pending scenario was skipped
+                    order = None
+                    continue
+                yield submit(*order.popleft())
+
+        for row in self.sumo.stream_steady(scenarios(), queue_depth, **stream_options):
+            i = in_flight.pop(row["Cmd_ID"])
+            results[i] = self._values(row)
+            done.append(i)
+            since_fit += 1
+            if since_fit >= refit_every or not trained:
+                if len(done) >= min(n_initial, n) or len(in_flight) == 0:
+                    screening = self._fit(done, results)
+                    trained = True
+                    since_fit = 0
+                    order = None
+        self._make_report(status, predictions, results)
+        return self.report
+
+    def _screen(self, pending, done, results, predictions):
+        """
+        (Internal) method, used to rank the pending scenarios and find the
+        ones to skip
+
+        Returns
+        -------
+        order : list, pending scenarios to simulate, most promising first
+        skip : list, pending scenarios predicted to be uninteresting
+        """
+        predicted = self._predict(pending)
+        lower = {an_output: mean - self.kappa * std for an_output, (mean, std) in predicted.items()}
+        infeasible = np.zeros(len(pending), dtype=bool)
+        for a_name, (limit, a_fun) in self.constraints.items():
+            infeasible |= lower[a_name] > limit
+        feasible_done = [results[i]["objective"] for i in done
+                         if all(results[i][a_name] <= limit for a_name, (limit, a_fun) in self.constraints.items())]
+        feasible_done = [v for v in feasible_done if not np.isnan(v)]
+        dominated = np.zeros(len(pending), dtype=bool)
+        if len(feasible_done) != 0:
+            dominated = lower["objective"] > min(feasible_done)
+        for j, i in enumerate(pending):
+            predictions[i] = {f"{an_output}_{stat}": predicted[an_output][k][j]
+                              for an_output in self.outputs for k, stat in enumerate(("mean", "std"))}
+        skip = list(pending[infeasible | dominated])
+        keep = ~(infeasible | dominated)
+        order = list(pending[keep][np.argsort(lower["objective"][keep])])
+        return order, skip
+
+    def _make_report(self, status, predictions, results):
+        """
+        (Internal) method, used to build self.report and self.validation
+        """
+        rows = []
+        for i, a_key in enumerate(self.keys):
+            rows.append({"Cmd_ID": a_key, "status": status[i], **self.param_dic[a_key],
+                         **predictions[i], **results.get(i, {})})
+        self.report = pd.DataFrame(rows)
+        simulated = self.report[self.report["status"].isin(["run", "validated"])]
+        predicted = simulated.dropna(subset=["objective_mean"]) if "objective_mean" in simulated else simulated.iloc[0:0]
+        self.validation = {"scenarios": len(self.keys),
+                           "simulated": len(simulated),
+                           "skipped": int((self.report["status"] == "skipped").sum())}
+        for an_output in self.outputs:
+            if len(predicted) == 0:
+                break
+            error = predicted[an_output] - predicted[f"{an_output}_mean"]
+            bound = self.kappa * predicted[f"{an_output}_std"]
+            self.validation[f"{an_output}_rmse"] = float(np.sqrt(np.mean(error ** 2)))
+            self.validation[f"{an_output}_coverage"] = float(np.mean(np.abs(error) <= bound))
+        # Validated scenarios would have been skipped: were they really uninteresting?
+        validated = self.report[self.report["status"] == "validated"]
+        if len(validated) != 0:
+            feasible = np.ones(len(validated), dtype=bool)
+            for a_name, (limit, a_fun) in self.constraints.items():
+                feasible &= validated[a_name].to_numpy() <= limit
+            ran = self.report[self.report["status"] == "run"]
+            best = ran["objective"].min() if len(ran) != 0 else np.inf
+            wrong = feasible & (validated["objective"].to_numpy() < best)
+            self.validation["validated"] = len(validated)
+            self.validation["false_skip_rate"] = float(np.mean(wrong))
+        print(f"------{self.validation['simulated']} of {len(self.keys)} scenarios simulated-----")
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+
+_AGGREGATES = ('last', 'mean', 'min', 'max')
+
+
+class _WindowGroup():
+    """
+    (Internal) class, used to aggregate the variables sharing the same window
+    and aggregates into one growing array of rows
+    """
+    def __init__(self, variables, window, aggregates, dtype, chunk_size):
+        self.variables = variables
+        self.window = window
+        self.aggregates = aggregates
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        self.columns = [a_var if aggregates == ('last',) else f"{a_var}__{an_agg}"
+                        for an_agg in aggregates for a_var in variables]
+        self.times = np.empty(chunk_size, dtype=np.float64)
+        self.data = np.empty((chunk_size, len(self.columns)), dtype=dtype)
+        self.rows = 0
+        self._reset()
+
+    def _reset(self):
+        n = len(self.variables)
+        self.count = 0
+        self.sum = np.zeros(n)
+        self.min = np.full(n, np.inf)
+        self.max = np.full(n, -np.inf)
+        self.last = np.zeros(n)
+        self.last_time = None
+
+    def _window_row(self):
+        values = {'last': self.last, 'mean': self.sum / self.count,
+                  'min': self.min, 'max': self.max}
+        return np.concatenate([values[an_agg] for an_agg in self.aggregates])
+
+    def append(self, t, data):
+        values = np.array([data[a_var] for a_var in self.variables], dtype=np.float64)
+        self.count += 1
+        self.sum += values
+        np.minimum(self.min, values, out=self.min)
+        np.maximum(self.max, values, out=self.max)
+        self.last = values
+        self.last_time = t
+        if self.count == self.window:
+            if self.rows == len(self.times):
+                self._grow()
+            self.times[self.rows] = t
+            self.data[self.rows] = self._window_row()
+            self.rows += 1
+            self._reset()
+
+    def _grow(self):
+        # The capacity doubles, so rows are copied O(1) times on average
+        capacity = max(2 * len(self.times), self.chunk_size)
+        times = np.empty(capacity, dtype=np.float64)
+        times[:self.rows] = self.times[:self.rows]
+        self.times = times
+        data = np.empty((capacity, len(self.columns)), dtype=self.dtype)
+        data[:self.rows] = self.data[:self.rows]
+        self.data = data
+
+    def arrays(self):
+        """
+        Return (times, data) including the incomplete last window
+        """
+        times = self.times[:self.rows]
+        data = self.data[:self.rows]
+        if self.count > 0:
+            times = np.append(times, self.last_time)
+            data = np.vstack([data, self._window_row().astype(self.dtype)])
+        return times, data
+
+
+def _join(frames):
+    """
+    (Internal) function, used to align the frames of the groups on time. With
+    several groups, a repeated time stamp keeps its last row in each group.
+    """
+    if len(frames) == 0:
+        return pd.DataFrame()
+    if len(frames) > 1:
+        frames = [a_frame[~a_frame.index.duplicated(keep='last')] for a_frame in frames]
+    return pd.concat(frames, axis=1, sort=True).reset_index()
+
+
+class TimeSeriesStore():
+    """
+    This is a compact storage of the data communicated by one dynamic
+    simulation. Instead of a pandas DataFrame growing row by row, values are
+    kept in preallocated arrays of a configurable dtype (e.g. float32), and
+    can be decimated or aggregated (min/max/mean) over windows of datacomm
+    rows while the simulation is running. Results are saved with lossless
+    compression (.npz).
+
+    Inputs:
+    --------------
+    (Optional)
+        `dtype`: numpy dtype, default = np.float32
+        The dtype of the stored values. Time is always kept as float64.
+
+        `window`: int, default = 1
+        Number of datacomm rows aggregated into one stored row, e.g. 12 with
+        a 5-minute `data_comm_freq` stores hourly rows
+
+        `aggregate`: string or tuple of strings, default = 'last'
+        The aggregates of each window, among 'last' (i.e. decimation),
+        'mean', 'min' and 'max', e.g. ('min', 'max', 'mean')
+
+        `windows`: dictionary, default = None
+        Per-variable (window, aggregate) overriding the defaults above
+        e.g. {"Sumo__Plant__Effluent__SNHx": (1, 'last'),
+              "Sumo__Plant__CSTR3__DOSP": (12, ('min', 'max'))}
+
+        `time_var`: string, default = "Sumo__Time"
+        The sumo incode variable used as time axis
+
+    Methods:
+    --------------
+        `append()`: add one datacomm row
+        `to_frame()`: return the stored data as a pd.DataFrame
+        `save()`: save the stored data to a compressed .npz file
+        `load()`: (static) read a .npz file saved by `save()` as a pd.DataFrame
+    """
+    def __init__(self, dtype = np.float32, window = 1, aggregate = 'last',
+                 windows = None, time_var = "Sumo__Time", chunk_size = 4096):
+        self.dtype = dtype
+        self.window = window
+        self.aggregate = aggregate
+        self.windows = {} if windows == None else windows
+        self.time_var = time_var
+        self.chunk_size = chunk_size
+        # Variables whose values are not numeric scalars (e.g. arrays, strings)
+        self.skipped = []
+        self._groups = None
+
+    def _aggregates(self, aggregate):
+        aggregates = (aggregate,) if isinstance(aggregate, str) else tuple(aggregate)
+        for an_agg in aggregates:
+            if an_agg not in _AGGREGATES:
+                raise ValueError(f"aggregate should be among {_AGGREGATES}, got {an_agg}")
+        return aggregates
+
+    def _set_up_groups(self, data):
+        """
+        (Internal) method, used to group variables by (window, aggregates)
+        from the first datacomm row
+        """
+        settings = {}
+        for a_var, a_val in data.items():
+            if a_var == self.time_var:
+                continue
+            if isinstance(a_val, bool) or not isinstance(a_val, (int, float)):
+                self.skipped.append(a_var)
+                continue
+            window, aggregate = self.windows.get(a_var, (self.window, self.aggregate))
+            settings.setdefault((window, self._aggregates(aggregate)), []).append(a_var)
+        self._groups = [_WindowGroup(variables, window, aggregates, self.dtype, self.chunk_size)
+                        for (window, aggregates), variables in settings.items()]
+
+    def append(self, data):
+        """
+        Parameters
+        ----------
+        data : dictionary
+            One datacomm row, keys: sumo incode variables, values: their values
+        """
+        if self._groups == None:
+            self._set_up_groups(data)
+        t = data[self.time_var]
+        for a_group in self._groups:
+            a_group.append(t, data)
+
+    def __len__(self):
+        if self._groups == None:
+            return 0
+        return max(a_group.rows + (a_group.count > 0) for a_group in self._groups)
+
+    @property
+    def nbytes(self):
+        """
+        Memory used by the stored rows, in bytes
+        """
+        if self._groups == None:
+            return 0
+        return sum(a_group.times[:a_group.rows].nbytes + a_group.data[:a_group.rows].nbytes
+                   for a_group in self._groups)
+
+    def to_frame(self):
+        """
+        Returns
+        -------
+        a_df : pd.DataFrame
+            Stored rows with the time variable as first column. Variables with
+            different windows are aligned on time, keeping the last row of a
+            repeated time stamp.
+        """
+        if self._groups == None:
+            return pd.DataFrame()
+        frames = []
+        for a_group in self._groups:
+            times, data = a_group.arrays()
+            frames.append(pd.DataFrame(data, index=pd.Index(times, name=self.time_var),
+                                       columns=a_group.columns))
+        return _join(frames)
+
+    def save(self, file_name):
+        """
+        Save the stored rows to a compressed (lossless) .npz file
+        """
+        arrays = {}
+        if self._groups != None:
+            for i, a_group in enumerate(self._groups):
+                times, data = a_group.arrays()
+                arrays[f"group{i}_time"] = times
+                arrays[f"group{i}_data"] = data
+                arrays[f"group{i}_columns"] = np.array(a_group.columns)
+        arrays["time_var"] = np.array(self.time_var)
+        np.savez_compressed(file_name, **arrays)
+
+    @staticmethod
+    def load(file_name):
+        """
+        Read a .npz file saved by `save()`
+
+        Returns
+        -------
+        a_df : pd.DataFrame, same as `to_frame()`
+        """
+        frames = []
+        with np.load(file_name) as arrays:
+            time_var = str(arrays["time_var"])
+            i = 0
+            while f"group{i}_time" in arrays:
+                frames.append(pd.DataFrame(arrays[f"group{i}_data"],
+                                           index=pd.Index(arrays[f"group{i}_time"], name=time_var),
+                                           columns=list(arrays[f"group{i}_columns"])))
+                i += 1
+        return _join(frames)
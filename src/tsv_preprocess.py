@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+from sumoscheduler import Duration as dur
+import os
+import hashlib
+import threading
+import numpy as np
+
+
+def _integral(times, values, new_times):
+    """
+    (Internal) function, used to integrate the linear interpolation of
+    (times, values) from times[0] to each of new_times
+    """
+    if len(times) < 2:
+        return values[0] * (new_times - times[0])
+    widths = np.diff(times)
+    cumulative = np.concatenate([[0.0], np.cumsum(widths * (values[1:] + values[:-1]) / 2)])
+    j = np.clip(np.searchsorted(times, new_times, side='right') - 1, 0, len(times) - 2)
+    # Repeated time stamps are steps of zero width
+    slopes = np.divide(np.diff(values), widths, out=np.zeros(len(widths)), where=widths > 0)
+    dt = new_times - times[j]
+    return cumulative[j] + dt * (values[j] + 0.5 * slopes[j] * dt)
+
+
+class TsvPreprocessor():
+    """
+    This is a preprocessor of the dynamic input tables (.tsv) loaded by
+    `loadtsv` in dynamic simulations. A large table (e.g. multi-year at
+    15-minute resolution) is parsed once into a binary intermediate (.npy),
+    keyed by the hash of its content, and every trial only gets a small
+    derived .tsv sliced to its `stop_time` and optionally resampled. Derived
+    tables are cached as well, so trials sharing the same table and
+    `stop_time` share the same file.
+
+    Inputs:
+    --------------
+    (Optional)
+        `cache_dir`: string, default = "tsv_cache"
+        The folder where the binary intermediates and derived .tsv are saved
+
+        `resample_freq`: int, default = None
+        The interval of the derived tables, e.g. 1*dur.hour. None keeps the
+        original rows.
+
+        `resample_method`: string, default = 'interp'
+        How values are resampled: 'interp' interpolates the table linearly at
+        each new row, which can miss peaks shorter than `resample_freq` when
+        downsampling; 'mean' gives each new row the mean of the (linearly
+        interpolated) table until the next row, which keeps the loads over
+        each interval. The last row is interpolated with both methods.
+
+        `variables`: list, default = None
+        The sumo incode variables of the model, e.g. SumoState("A2O.xml").names().
+        If given, the columns of every table are validated against it.
+
+        `time_unit`: int, default = dur.day
+        The unit of the "Sumo__Time" column in the tables
+
+    Methods:
+    --------------
+        `prepare()`: return the derived .tsv of a table for a given stop time
+
+    Examples:
+    --------------
+        tsv = TsvPreprocessor(resample_freq = 1*dur.hour)
+        test = CY_SUMO(model = model, sumo_variables = sumo_variables,
+                       tsv_preprocessor = tsv)
+    """
+    def __init__(self, cache_dir = "tsv_cache", resample_freq = None,
+                 variables = None, time_unit = dur.day, resample_method = 'interp'):
+        if resample_method not in ('interp', 'mean'):
+            raise ValueError(f"resample_method should be 'interp' or 'mean', got {resample_method}")
+        self.cache_dir = cache_dir
+        self.resample_freq = resample_freq
+        self.resample_method = resample_method
+        self.variables = None if variables == None else set(variables)
+        self.time_unit = time_unit
+        # keys: (path, size, mtime); values: content hash
+        self._hashes = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _content_hash(self, tsv_file):
+        """
+        (Internal) method, used to hash the content of a table, once per
+        version of the file
+        """
+        stat = os.stat(tsv_file)
+        key = (os.path.abspath(tsv_file), stat.st_size, stat.st_mtime)
+        if key not in self._hashes:
+            sha = hashlib.sha1()
+            with open(tsv_file, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    sha.update(chunk)
+            self._hashes[key] = sha.hexdigest()
+        return self._hashes[key]
+
+    def _load_table(self, tsv_file):
+        """
+        (Internal) method, used to load a table as (columns, memory-mapped
+        array), parsing the .tsv only if its binary intermediate is missing
+        """
+        content_hash = self._content_hash(tsv_file)
+        npy_file = os.path.join(self.cache_dir, f"{content_hash}.npy")
+        header_file = os.path.join(self.cache_dir, f"{content_hash}.header")
+        if not os.path.isfile(npy_file):
+            with open(tsv_file) as f:
+                columns = f.readline().rstrip("\r\n").split("\t")
+            data = np.loadtxt(tsv_file, delimiter="\t", skiprows=1, ndmin=2)
+            # Write to temporary names first, other threads or processes may
+            # share the cache
+            suffix = f".{os.getpid()}.{threading.get_ident()}"
+            with open(header_file + suffix, 'w') as f:
+                f.write("\t".join(columns))
+            os.replace(header_file + suffix, header_file)
+            with open(npy_file + suffix, 'wb') as f:
+                np.save(f, data)
+            os.replace(npy_file + suffix, npy_file)
+        with open(header_file) as f:
+            columns = f.read().split("\t")
+        self._validate(columns, tsv_file)
+        return content_hash, columns, np.load(npy_file, mmap_mode='r')
+
+    def _validate(self, columns, tsv_file):
+        """
+        (Internal) method, used to check the columns of a table
+        """
+        if columns[0] != "Sumo__Time":
+            raise ValueError(f"The first column of {tsv_file} should be Sumo__Time")
+        if self.variables != None:
+            unknown = [a_col for a_col in columns[1:] if a_col not in self.variables]
+            if len(unknown) != 0:
+                raise ValueError(f"Columns of {tsv_file} are not model variables: {unknown}")
+
+    def prepare(self, tsv_file, stop_time):
+        """
+        Parameters
+        ----------
+        tsv_file : string
+            The original table, e.g. 'Influent_Table1.tsv'
+        stop_time : int
+            The stop time of the trial, e.g. 1*dur.day
+
+        Returns
+        -------
+        derived_file : string
+            The derived .tsv covering [0, stop_time]
+        """
+        content_hash, columns, data = self._load_table(tsv_file)
+        derived_file = os.path.join(self.cache_dir,
+                                    f"{content_hash}_{stop_time}_{self.time_unit}_"
+                                    f"{self.resample_freq}_{self.resample_method}.tsv")
+        if os.path.isfile(derived_file):
+            return derived_file
+        stop = stop_time / self.time_unit
+        times = data[:, 0]
+        # Keep one row beyond stop_time so the core can interpolate up to it
+        end = min(int(np.searchsorted(times, stop, side='left')) + 1, len(times))
+        window = np.array(data[:end])
+        if self.resample_freq != None:
+            step = self.resample_freq / self.time_unit
+            # Up to the first grid point at or after stop, as the row kept 
+            # above, clipped to the end of the table
+            n_steps = max(int(np.ceil((stop - window[0, 0]) / step - 1e-9)), 0)
+            new_times = window[0, 0] + step * np.arange(n_steps + 1)
+            new_times = np.unique(np.minimum(new_times, window[-1, 0]))
+            resampled = [new_times]
+            for i in range(1, window.shape[1]):
+                values = np.interp(new_times, window[:, 0], window[:, i])
+                if self.resample_method == 'mean' and len(new_times) > 1:
+                    integral = _integral(window[:, 0], window[:, i], new_times)
+                    values[:-1] = np.diff(integral) / np.diff(new_times)
+                resampled.append(values)
+            window = np.column_stack(resampled)
+        temp_file = derived_file + f".{os.getpid()}.{threading.get_ident()}"
+        np.savetxt(temp_file, window, delimiter="\t", fmt="%.10g",
+                   header="\t".join(columns), comments="")
+        os.replace(temp_file, derived_file)
+        return derived_file